@@ -1,7 +1,24 @@
 # -*- coding: UTF-8 -*-
 #Imports
+import argparse
+import copy
+import csv
+import functools
+import io
+import itertools
+import json
 import math
-
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+# Keep standard output clean for the headless command line tools
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
 import pygame
 from pygame.locals import *
 
@@ -20,6 +37,94 @@ DARKBLUE = (24,76,160)
 LIGHTGREY = (220,220,220)
 MEDIUMGREY = (130,130,130)
 
+# Distance the laser particle moves each step of the particle engine
+PARTICLE_STEP = 0.5
+# Change in intensity covered by each line drawn for a beam, smaller is a smoother fade
+FADE_STEP = 10
+# Refractive index given to blocks added in the simulator (crown glass)
+BLOCK_N = 1.52
+# Ways of tracing laser paths
+ENGINES = ("particle", "ray", "adaptive")
+# Hits on curved surfaces closer than this are ignored, so a ray leaving an arc doesn't hit it again straight away
+ARC_EPSILON = 1e-7
+# Furthest the lines approximating a curve (0.1 radian apart) are from the true curve, as a fraction of its radius
+ARC_SAGITTA = 1 - math.cos(0.05)
+# Distance past a surface that is checked to find which block a beam is going into
+MEDIUM_EPSILON = 1e-6
+# Wavelengths in nm traced for a laser giving white light
+VISIBLE_SPECTRUM = tuple(range(400, 701, 10))
+# Lasers with partial reflection stop following rays with less than this share of their power,
+# and stop splitting once rays are this many reflections deep or there are this many rays
+FRESNEL_THRESHOLD = 0.01
+FRESNEL_MAXDEPTH = 8
+FRESNEL_MAXRAYS = 500
+# Rays traced together at a time when measuring with detectors, limiting how much memory each batch needs
+DETECT_CHUNK = 65536
+# Wavelengths of a spectrum traced for the quick preview of a beam shown while the scene is changing
+PREVIEW_WAVELENGTHS = 4
+# Event posted when paths traced in the background are ready, waking the main loop if it is waiting for input
+TRACED = pygame.event.custom_type()
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(name, size):
+    ''' System font name at size, only loaded once however many scenes use it'''
+    return pygame.font.SysFont(name, size)
+
+class TextCache:
+
+    ''' Rendered lines of text shared by every scene, so text that is drawn again or appears in several places is only
+    rendered once. Only the maxsize most recently used are kept'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        # Rendered text by font, text and colour, least recently used first
+        self.rendered = OrderedDict()
+
+    def render(self, font, text, colour):
+        ''' Antialiased surface of text in font and colour'''
+        key = (font, text, tuple(colour))
+        if key in self.rendered:
+            self.rendered.move_to_end(key)
+            return self.rendered[key]
+
+        image = font.render(text, True, colour)
+        self.rendered[key] = image
+        if len(self.rendered) > self.maxsize:
+            self.rendered.popitem(last=False)
+        return image
+
+    def clear(self):
+        self.rendered.clear()
+
+TEXT_CACHE = TextCache()
+
+class Label:
+
+    '''Line of text on screen, only rendered again when its text, font or colour changes'''
+
+    def __init__(self, text, fontname, fontcolor):
+        self.text = text
+        self.fontname = fontname
+        self.fontcolor = fontcolor
+        self._key = None
+        self._image = None
+
+    def image(self, assets):
+        ''' Rendered text, using the font called fontname in assets'''
+        font = assets[self.fontname]
+        if self._key != (self.text, font, self.fontcolor):
+            self._image = TEXT_CACHE.render(font, self.text, self.fontcolor)
+            self._key = (self.text, font, self.fontcolor)
+        return self._image
+
+    def draw(self, screen, alignment, coords, assets):
+        ''' Draw with the point of its rect named by alignment, such as "bottomleft", at coords. Returns the area drawn'''
+        image = self.image(assets)
+        rect = image.get_rect()
+        setattr(rect, alignment, coords)
+        screen.blit(image, rect)
+        return rect
 
 class Button:
 
@@ -28,13 +133,20 @@ class Button:
     def __init__(self, x, y, text, fontname, fontcolor, fillcolor, bordercolor):
         self.fillrect = pygame.Rect(x,y,0,0) # Width and height adjusted when text is rendered
         self.bordrect = pygame.Rect(x,y,0,0)
-        self.text = text
+        self.label = Label(text, fontname, fontcolor)
         self.pressed = False
-        self.fontname = fontname
-        self.fontcolor = fontcolor
         self.fillcolor = fillcolor
         self.bordcolor = bordercolor
 
+    # Text is kept by the label so it knows when to render it again
+    @property
+    def text(self):
+        return self.label.text
+
+    @text.setter
+    def text(self, text):
+        self.label.text = text
+
     def handle_event(self, event):
         # Check if clicked on
         if event.type == MOUSEBUTTONDOWN:
@@ -42,20 +154,19 @@ class Button:
                self.pressed = True
 
     def draw(self, screen, alignment, coords, assets):
+        text = self.label.image(assets)
+        #Adjust fill and border to the size of the text first, so the button is aligned right the first time it is drawn
+        self.fillrect.w = self.bordrect.w = text.get_width() + 5
+        self.fillrect.h = self.bordrect.h = text.get_height() + 5
         #Update position based on given coordinates
-        exec("self.fillrect.{0} = self.bordrect.{0} = {1}".format(alignment,coords))
+        setattr(self.fillrect, alignment, coords)
+        setattr(self.bordrect, alignment, coords)
         #Fill
         pygame.draw.rect(screen, self.fillcolor, self.fillrect)
         #Border
         pygame.draw.rect(screen, self.bordcolor, self.bordrect,2)
         #Text
-        text = assets[self.fontname].render(self.text,True,self.fontcolor)
-        textRect = text.get_rect(topleft=(self.fillrect.topleft[0]+3,self.fillrect.topleft[1]+3))
-        screen.blit(text,textRect)
-
-        #Adjust fill and border to the size of the text
-        self.fillrect.w = self.bordrect.w = textRect.w + 5
-        self.fillrect.h = self.bordrect.h = textRect.h + 5
+        screen.blit(text, (self.fillrect.left+3, self.fillrect.top+3))
 
 class BaseScene:
 
@@ -65,6 +176,12 @@ class BaseScene:
     def __init__(self):
         # Stay on same scene by default
         self.next = self
+        # Beam paths traced during the last Render, for profiling
+        self.traced = []
+        # Areas of the screen to draw again at the next Render, None for all of it
+        self.invalid = None
+        # Areas of the screen changed by the last Render to pass to pygame.display.update, None for all of it
+        self.dirty = None
 
     def SwitchToScene(self, next_scene):
         ''' Move to scene at the end of the loop'''
@@ -74,6 +191,19 @@ class BaseScene:
         ''' Close the program at the end of the loop'''
         self.next = None
 
+    def Invalidate(self, rects=None):
+        ''' Mark a list of areas of the screen to be drawn again at the next Render, or all of it if none are given.
+        Scenes that only draw what has changed use this to know what was drawn over or lost'''
+        if rects is None:
+            self.invalid = None
+        elif self.invalid is not None:
+            self.invalid.extend(pygame.Rect(rect) for rect in rects)
+
+    def Policy(self):
+        ''' How the main loop should run the scene. "live" runs it every frame at the full frame rate, for when something
+        changes without any input, and "idle" only runs it when an event arrives'''
+        return "live"
+
     def DrawBanner(self, screen, assets):
         ''' Draw title banner at the top of the screen'''
         # White background, blue banner
@@ -81,7 +211,7 @@ class BaseScene:
         pygame.draw.rect(screen,MEDIUMBLUE,(0,0,screen.get_width(),45),0)
 
         # Title
-        titleText = assets['largeFont'].render(self.title,True,WHITE)
+        titleText = TEXT_CACHE.render(assets['largeFont'], self.title, WHITE)
         titleTextRect = titleText.get_rect(midtop=(screen.get_width()/2, 2))
         screen.blit(titleText,titleTextRect)
 
@@ -91,127 +221,235 @@ class BaseScene:
         raise NotImplementedError
 
     def Render(self, screen, assets):
-        ''' Draws graphics to "screen" surface that is updated at the end of each loop'''
+        ''' Draws graphics to "screen" surface that is updated at the end of each loop, only in the areas listed in
+        dirty unless it is None'''
         raise NotImplementedError
 
+class SpriteCache:
+
+    ''' Loads and scales an image once, then keeps rotated copies of it. Angles are rounded to the nearest step
+    degrees and only the maxsize most recently used rotations are kept'''
+
+    def __init__(self, filename, size, step=1, maxsize=128):
+        self.filename = filename
+        self.size = size
+        self.step = step
+        self.maxsize = maxsize
+        self.base = None
+        # Rotated images by angle, least recently used first
+        self.rotated = OrderedDict()
+
+    def get(self, rot):
+        ''' Image rotated anticlockwise by rot degrees'''
+        angle = round(rot / self.step) * self.step % 360
+        if angle in self.rotated:
+            self.rotated.move_to_end(angle)
+            return self.rotated[angle]
+
+        if self.base is None:
+            self.base = pygame.transform.smoothscale(pygame.image.load(self.filename), self.size)
+        image = pygame.transform.rotate(self.base, angle)
+        self.rotated[angle] = image
+        if len(self.rotated) > self.maxsize:
+            self.rotated.popitem(last=False)
+        return image
+
+@functools.lru_cache(maxsize=None)
+def laser_sprites(scale):
+    ''' Pointer images for drawing a scene scale times its size'''
+    if scale == 1:
+        return LASER_SPRITES
+    width, height = LASER_SPRITES.size
+    return SpriteCache(LASER_SPRITES.filename, (round(width*scale), round(height*scale)))
+
+# Pointer image shared by every laser, w=38 and h=72 generally appropriate on most monitors. Every rotation is kept,
+# as redrawing a scene of lasers at more different angles than are kept would rotate the image again for each one
+LASER_SPRITES = SpriteCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), "laser.png"), (38,72), maxsize=360)
+
 ## Objects for simulator
 class Laser:
 
     '''Object for simulator. Includes emission of laser particle that draws beam'''
 
-    def __init__(self, center, rot=0, decayincr=0.5, on=True):
+    # A laser gives out a single ray. Light sources of many rays are always traced together by trace_batched
+    batched = False
+
+    def __init__(self, center, rot=0, decayincr=0.5, on=True, spectrum=None, fresnel=False):
 
         self.center = center
-        # w=38 and h=72 generally appropriate on most monitors
-        self.width = 38
-        self.height = 72
+        # Size of the pointer image
+        self.width, self.height = LASER_SPRITES.size
         # Rotation given in degrees, math module works in radians
         self.rotdeg = rot
         self.rotrads = math.radians(rot)
 
-        # Load pointer image and transform to correct position
-        temp_image = pygame.image.load("laser.png")
-        temp_image = pygame.transform.smoothscale(temp_image, (self.width, self.height))
-        self.image = pygame.transform.rotate(temp_image, rot)
-        self.rect = self.image.get_rect(center=center)
-
         # On or off
         self.on = on
         # Decay light path (to white). Bigger number means quicker decay
         self.decayincr = decayincr
+        # Wavelengths in nm the laser gives out, such as VISIBLE_SPECTRUM. None for a plain red laser
+        self.spectrum = spectrum
+        # Partially reflect at every block surface as well as refracting
+        self.fresnel = fresnel
+
+        # Last traced path and what it was traced with, so it is only retraced when something changes
+        self.path = None
+        self.pathkey = None
+        # TraceJob the laser was last sent to be traced in the background in, None if it has changed since
+        self.queued = None
+
+    def set_rotation(self, rot):
+        ''' Point the laser at rot degrees, keeping everything else'''
+        self.rotdeg = rot
+        self.rotrads = math.radians(rot)
+        self.pathkey = None
+        self.queued = None
+
+    @property
+    def image(self):
+        # Pointer image comes from the shared cache so lasers can be made and traced without loading it
+        return LASER_SPRITES.get(self.rotdeg)
+
+    @property
+    def rect(self):
+        return self.image.get_rect(center=self.center)
+
+    def draw(self, screen, scale=1):
+        # Draw pointer, from a larger image when the whole scene is drawn larger
+        image = laser_sprites(scale).get(self.rotdeg)
+        screen.blit(image, image.get_rect(center=(self.center[0]*scale, self.center[1]*scale)))
+
+    def emission_point(self):
+        ''' Position of the tip of the pointer, where the beam starts'''
+        x,y = self.center
+        x -= self.height*math.sin(self.rotrads)/2
+        y -= self.height*math.cos(self.rotrads)/2
+        return x,y
 
-    def draw(self, screen):
-        # Draw pointer
-        screen.blit(self.image, self.rect)
+    def rays(self):
+        ''' Starting points and unit directions of the rays given out, as arrays x, y, dx, dy. Just one for a laser'''
+        x,y = self.emission_point()
+        return np.array([x]), np.array([y]), np.array([-math.sin(self.rotrads)]), np.array([-math.cos(self.rotrads)])
 
-    def emit_particle(self, screen, mirrors, blocks):
+    def emit_particle(self, screen, mirrors, blocks, geometry=None):
         ''' Draws laser path by emitting particle that interacts with given mirrors and blocks'''
 
         # Check that it should be emitting
         if self.on == False:
             return
 
+        draw_path(screen, self.march(screen.get_size(), mirrors, blocks, geometry))
+
+    def march(self, bounds, mirrors, blocks, geometry=None):
+        ''' Traces laser path by emitting particle that moves in small steps and interacts with given mirrors and blocks.
+        A SceneGeometry of the same mirrors and blocks can be given to skip checking each line when none are close.
+        Returns a BeamPath of the points where the particle changed direction'''
+
+        starttime = time.perf_counter()
+
         # Set particle to correct position based on pointer
-        x,y = self.rect.center
-        x -= self.height*math.sin(self.rotrads)/2
-        y -= self.height*math.cos(self.rotrads)/2
-        partRect = pygame.Rect(x,y,3,3)
-        partRect.center = (x,y)
+        x,y = self.emission_point()
+        path = BeamPath((x,y), self.rotrads % (2 * PI))
+
+        # Check that it should be emitting
+        if self.on == False:
+            return path
+        width, height = bounds
+
+        # Line tests are counted for profiling, by the geometry or here when lines are checked one at a time
+        geometrytests = geometry.tests if geometry is not None else 0
+        linecount = sum(len(mirror.lines) for mirror in mirrors) + sum(len(block.points) for block in blocks)
 
         # Set initial direction
         currangle = self.rotrads
         # Small multiplier increases accuracy of collision points but slows down rendering
-        velMultiplier = 0.5
+        velMultiplier = PARTICLE_STEP
         xvel = - math.sin(self.rotrads) * velMultiplier
         yvel = - math.cos(self.rotrads) * velMultiplier
 
-        # Starts in air so refractive index of 1
-        currn = 1
+        # Starts in whichever block the laser is in, or air. The particle collides with the lines
+        # through the points of blocks so it is inside a block if it is inside that outline
+        block = block_at(x, y, blocks, outline=True)
+        currn = 1 if block is None else block.n
+        path.ns[0] = currn
 
         # Intensity decays as it goes
         intensity = 0
 
-        while 0 < x < screen.get_width() and 0 < y < screen.get_height():
-
-            for mirror in mirrors:
-                if mirror.line.dist((x,y)) <= 0.5 * velMultiplier:
-
-                    spinangle = 2 * PI - currangle
-
-                    #Relative position of point1 on line
-                    linerelx1 = mirror.line.x1 - x
-                    linerely1 = y - mirror.line.y1
-                    #Rotate for particle's perspective
-                    spunx1 = math.cos(spinangle)*linerelx1 - math.sin(spinangle)*linerely1
-                    spuny1 = math.sin(spinangle)*linerelx1 + math.cos(spinangle)*linerely1
-
-                    #Relative position of point2 on line
-                    linerelx2 = mirror.line.x2 - x
-                    linerely2 = y - mirror.line.y2
-                    #Rotate for particle's perspective
-                    spunx2 = math.cos(spinangle)*linerelx2 - math.sin(spinangle)*linerely2
-                    spuny2 = math.sin(spinangle)*linerelx2 + math.cos(spinangle)*linerely2
-
-                    #Only consider point to the left of collision
-                    if spunx1 < 0:
-                        spunx = spunx1
-                        spuny = spuny1
-                    elif spunx2 < 0:
-                        spunx = spunx2
-                        spuny = spuny2
-                    else:
-                        # Particle direction near parallel to mirror line
-                        # To avoid program crash, let go in straight line
-                        continue
-
-                    #Calc theta1
-                    if spuny == 0:
-                        # Head on collision
-                        theta1 = 0
-                    else:
-                        theta1 = math.atan(spuny/spunx)
-
-                    # Amount that the particle direction turns to the "right"
-                    newrelangle = PI - 2 * theta1
-                    # Set to new direction
-                    currangle -= newrelangle
-                    # Make sure 0 <= angle < 2pi
-                    currangle %= 2 * PI
-                    # Set new velocities
-                    xvel = - math.sin(currangle) * velMultiplier
-                    yvel = - math.cos(currangle) * velMultiplier
-
-            for block in blocks:
+        while 0 < x < width and 0 < y < height:
+
+            # Position at the start of the step is recorded if the direction changes
+            stepx, stepy = x, y
+            event = None
+            path.steps += 1
+
+            # One vectorised distance check against every line decides whether any are worth checking individually
+            if geometry is None or geometry.any_within(x, y, 0.5 * velMultiplier):
+                nearmirrors, nearblocks = mirrors, blocks
+                path.tests += linecount
+            else:
+                nearmirrors = nearblocks = ()
+
+            for mirror in nearmirrors:
+                for line in mirror.lines:
+                    if line.dist((x,y)) <= 0.5 * velMultiplier:
+
+                        spinangle = 2 * PI - currangle
+
+                        #Relative position of point1 on line
+                        linerelx1 = line.x1 - x
+                        linerely1 = y - line.y1
+                        #Rotate for particle's perspective
+                        spunx1 = math.cos(spinangle)*linerelx1 - math.sin(spinangle)*linerely1
+                        spuny1 = math.sin(spinangle)*linerelx1 + math.cos(spinangle)*linerely1
+
+                        #Relative position of point2 on line
+                        linerelx2 = line.x2 - x
+                        linerely2 = y - line.y2
+                        #Rotate for particle's perspective
+                        spunx2 = math.cos(spinangle)*linerelx2 - math.sin(spinangle)*linerely2
+                        spuny2 = math.sin(spinangle)*linerelx2 + math.cos(spinangle)*linerely2
+
+                        #Only consider point to the left of collision
+                        if spunx1 < 0:
+                            spunx = spunx1
+                            spuny = spuny1
+                        elif spunx2 < 0:
+                            spunx = spunx2
+                            spuny = spuny2
+                        else:
+                            # Particle direction near parallel to mirror line
+                            # To avoid program crash, let go in straight line
+                            continue
+
+                        #Calc theta1
+                        if spuny == 0:
+                            # Head on collision
+                            theta1 = 0
+                        else:
+                            theta1 = math.atan(spuny/spunx)
+
+                        # Amount that the particle direction turns to the "right"
+                        newrelangle = PI - 2 * theta1
+                        # Set to new direction
+                        currangle -= newrelangle
+                        # Make sure 0 <= angle < 2pi
+                        currangle %= 2 * PI
+                        # Set new velocities
+                        xvel = - math.sin(currangle) * velMultiplier
+                        yvel = - math.cos(currangle) * velMultiplier
+                        event = "reflect"
+
+            for block in nearblocks:
                 for line in block.lines:
                     if line.dist((x,y)) < 0.5 * velMultiplier:
 
-                        # Passing through wall of block so refracting
-                        if block.n == currn:
-                            # Going out
-                            newn = 1
-                        else:
-                            # Going in
-                            newn = block.n
+                        # Passing through wall of block so refracting, into whatever is just the other side of the line.
+                        # That may be air, or another block touching or inside this one
+                        nx, ny = line.normal()
+                        side = (x - line.x1) * nx + (y - line.y1) * ny
+                        beyond = block_at(*past_surface(x - side*nx, y - side*ny, xvel, yvel, nx, ny), blocks, outline=True)
+                        newn = 1 if beyond is None else beyond.n
 
                         spinangle = 2 * PI - currangle
 
@@ -256,8 +494,10 @@ class Laser:
                                 newrelangle =  -PI + 2 * theta1
                             # Staying in block so set newn back to currn
                             newn = currn
+                            event = "tir"
                         else:
                             # Normal refraction
+                            event = "refract"
                             theta2 = math.asin(currn * math.sin(theta1) / newn)
                             if spuny <= 0:
                                 newrelangle = -theta1 + theta2
@@ -276,19 +516,858 @@ class Laser:
                         x += 2*xvel
                         y += 2*yvel
 
+            if event is not None:
+                path.add((stepx,stepy), intensity, currangle, currn, event)
+
             #Update position
             x += xvel
             y += yvel
-            partRect.center = (x,y)
 
-            # Decay intensity and update colour
+            # Decay intensity
             intensity += self.decayincr
-            # Threshold for now white and stop rendering path
+            # Threshold for now white and stop path
             if intensity > 250:
                 break
-            colour = (255,intensity,intensity)
 
-            pygame.draw.rect(screen, colour, partRect)
+        path.add((x,y), intensity, currangle, currn, "end")
+        if geometry is not None:
+            path.tests += geometry.tests - geometrytests
+        path.tracetime = time.perf_counter() - starttime
+        return path
+
+    def beamkey(self, engine, bounds, geometry, fresnel=False):
+        ''' What the path traced by engine depends on other than the laser itself, the path needs tracing again if
+        this is different to pathkey'''
+        return (engine, tuple(bounds), geometry.version, self.fresnel or fresnel)
+
+    def beam(self, engine, bounds, mirrors, blocks, geometry, fresnel=False):
+        ''' Path of the laser traced by engine, one of ENGINES, reusing the last path if the
+        geometry version and screen size are unchanged'''
+        key = self.beamkey(engine, bounds, geometry, fresnel)
+        if key != self.pathkey:
+            self.path = self.trace(engine, bounds, mirrors, blocks, geometry, fresnel)
+            self.pathkey = key
+        return self.path
+
+    def trace(self, engine, bounds, mirrors, blocks, geometry=None, fresnel=False):
+        ''' Path of the laser traced by engine, one of ENGINES. Partial reflections are followed if fresnel is set
+        for the laser or given here. Light sources, and lasers with a spectrum or partial reflection, are always
+        traced by trace_batched as the other engines follow a single ray'''
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine {}".format(engine))
+        if self.batched or self.spectrum is not None or self.fresnel or fresnel:
+            return self.trace_batched(bounds, mirrors, blocks, geometry, fresnel)
+        if engine == "ray":
+            return self.trace_ray(bounds, mirrors, blocks, geometry)
+        elif engine == "particle":
+            return self.march(bounds, mirrors, blocks, geometry)
+        return self.march_adaptive(bounds, mirrors, blocks, geometry)
+
+    def preview(self):
+        ''' Copy of the laser that is quicker to trace, for showing roughly where its beam goes while the scene is
+        changing. It doesn't partially reflect and only gives out a few wavelengths of a spectrum'''
+        laser = copy.copy(self)
+        laser.fresnel = False
+        if self.spectrum is not None:
+            laser.spectrum = self.spectrum[::max(1, len(self.spectrum) // PREVIEW_WAVELENGTHS)]
+        return laser
+
+    def trace_ray(self, bounds, mirrors, blocks, geometry=None, maxbounces=500):
+        ''' Traces laser path as a ray that jumps straight to the nearest intersection with the given mirrors and blocks.
+        If a SceneGeometry is given it is used to test all surfaces at once instead.
+        Returns a BeamPath of the points where the beam changes direction'''
+
+        starttime = time.perf_counter()
+
+        x,y = self.emission_point()
+        path = BeamPath((x,y), self.rotrads % (2 * PI))
+
+        # Check that it should be emitting and starts on screen
+        width, height = bounds
+        if self.on == False or not (0 < x < width and 0 < y < height):
+            return path
+
+        # Line tests are counted for profiling, by the geometry or here when lines are checked one at a time
+        geometrytests = geometry.tests if geometry is not None else 0
+        surfacecount = sum(len(obj.surfaces) for obj in mirrors + blocks)
+
+        # Set initial direction as a unit vector
+        dx = - math.sin(self.rotrads)
+        dy = - math.cos(self.rotrads)
+
+        # Starts in whichever block the laser is in, or air
+        if geometry is not None:
+            currn = geometry.index_at(x, y)
+        else:
+            block = block_at(x, y, blocks)
+            currn = 1 if block is None else block.n
+        path.ns[0] = currn
+
+        # Beam fades to white at the same distance as the particle engine
+        maxlength = 250 * PARTICLE_STEP / self.decayincr
+        travelled = 0
+
+        # Line that was last hit is skipped so the ray can't collide with it again straight away.
+        # Arcs can be hit again, by total internal reflection round a curve, so the geometry ignores very close hits instead
+        lastline = None
+
+        for bounce in range(maxbounces):
+            path.steps += 1
+
+            # Find nearest line that the ray hits
+            if geometry is not None:
+                nearestt, nearestline = geometry.nearest_hit(x, y, dx, dy, lastline)
+                if nearestline >= 0:
+                    nx, ny = geometry.normal(nearestline, x + nearestt*dx, y + nearestt*dy)
+                    ismirror = geometry.is_mirror(nearestline)
+            else:
+                nearestt, nearestline, nearestobj = nearest_surface(x, y, dx, dy, mirrors + blocks, lastline)
+                path.tests += surfacecount
+                if nearestline is not None:
+                    nx, ny = nearestline.normal(x + nearestt*dx, y + nearestt*dy)
+                    ismirror = nearestobj.interaction == "reflect"
+
+            # Beam stops at the edge of the screen or when it has faded
+            stopt = min(edge_distance(x, y, dx, dy, width, height), maxlength - travelled)
+            if nearestt >= stopt:
+                travelled += stopt
+                path.add((x + stopt*dx, y + stopt*dy), travelled / PARTICLE_STEP * self.decayincr, direction_angle(dx, dy), currn, "end")
+                break
+
+            # Move to collision point
+            x += nearestt * dx
+            y += nearestt * dy
+            travelled += nearestt
+            lastline = nearestline
+
+            # Refractive index of whatever is on the other side, which may be another block touching or inside this one
+            newn = None
+            if not ismirror:
+                if geometry is not None:
+                    newn = geometry.index_beyond(x, y, dx, dy, nx, ny)
+                else:
+                    block = block_at(*past_surface(x, y, dx, dy, nx, ny), blocks)
+                    newn = 1 if block is None else block.n
+            dx, dy, currn, event = interact(dx, dy, nx, ny, currn, ismirror, newn)
+            path.add((x,y), travelled / PARTICLE_STEP * self.decayincr, direction_angle(dx, dy), currn, event)
+
+        if geometry is not None:
+            path.tests += geometry.tests - geometrytests
+        path.tracetime = time.perf_counter() - starttime
+        return path
+
+    def trace_batched(self, bounds, mirrors, blocks, geometry=None, fresnel=False):
+        ''' Traces every ray given out at every wavelength of the laser's spectrum at once with trace_batch, so blocks
+        with a dispersion model split the beam, and follows partial reflections if fresnel is set for the laser or
+        given. Uses a SceneGeometry
+        of the mirrors and blocks, made if not given. Returns a BeamSet'''
+        starttime = time.perf_counter()
+        if self.on == False:
+            return BeamSet([])
+        if geometry is None:
+            geometry = SceneGeometry()
+            for obj in mirrors + blocks:
+                geometry.add(obj)
+        geometrytests = geometry.tests
+
+        x, y, dx, dy = self.rays()
+        count = len(x)
+        wavelengths = self.spectrum
+        if wavelengths is not None:
+            # Each ray once for each wavelength
+            x, y, dx, dy = (np.repeat(values, len(wavelengths)) for values in (x, y, dx, dy))
+            wavelengths = np.tile(np.asarray(wavelengths, dtype=float), count)
+        # Each starting ray can split off as many rays as a laser
+        beams = trace_batch(bounds, geometry, x, y, dx, dy, wavelengths, 250 * PARTICLE_STEP / self.decayincr,
+                            fresnel=self.fresnel or fresnel, maxrays=FRESNEL_MAXRAYS * count)
+        beams.tests = geometry.tests - geometrytests
+        beams.tracetime = time.perf_counter() - starttime
+        return beams
+
+    def march_adaptive(self, bounds, mirrors, blocks, geometry=None, closedist=1, tolerance=1e-8, maxsteps=100000):
+        ''' Traces laser path by marching a particle like march, but with steps as long as the distance to the
+        nearest line so it can never step through one. Within closedist of a line it takes short steps instead and
+        when one crosses a line the collision point is found to within tolerance by bisection.
+        Uses a SceneGeometry of the mirrors and blocks, made if not given. Returns a BeamPath'''
+        starttime = time.perf_counter()
+
+        x,y = self.emission_point()
+        path = BeamPath((x,y), self.rotrads % (2 * PI))
+
+        # Check that it should be emitting and starts on screen
+        width, height = bounds
+        if self.on == False or not (0 < x < width and 0 < y < height):
+            return path
+
+        if geometry is None:
+            geometry = SceneGeometry()
+            for obj in mirrors + blocks:
+                geometry.add(obj)
+        geometrytests = geometry.tests
+
+        # Set initial direction as a unit vector
+        dx = - math.sin(self.rotrads)
+        dy = - math.cos(self.rotrads)
+
+        # Starts in whichever block the laser is in, or air
+        currn = geometry.index_at(x, y)
+        path.ns[0] = currn
+
+        # Beam fades to white at the same distance as the particle engine
+        maxlength = 250 * PARTICLE_STEP / self.decayincr
+        travelled = 0
+
+        # Line that was last hit is ignored until another surface is hit, like the ray engine
+        lastline = -1
+
+        while path.steps < maxsteps:
+            path.steps += 1
+            stopt = min(edge_distance(x, y, dx, dy, width, height), maxlength - travelled)
+
+            if geometry.count + geometry.arccount:
+                dists = geometry.surface_distances(x, y)
+                if lastline >= 0:
+                    dists[lastline] = math.inf
+                nearest = float(dists.min())
+            else:
+                nearest = math.inf
+
+            if nearest > closedist:
+                # Open space. Stopping half of closedist short of the nearest line means it can't be reached
+                step = nearest - closedist / 2
+                if step >= stopt:
+                    break
+                x += step * dx
+                y += step * dy
+                travelled += step
+                continue
+
+            # Close to a line, short step checking each nearby line for which side of it the particle is on
+            step = 2 * closedist
+            if step >= stopt:
+                break
+            near = np.nonzero(dists <= nearest + step)[0]
+            # Only surfaces the step really passes through, not ones it only crosses the line through beyond an end
+            near = near[geometry.surface_intersect(x, y, dx, dy, near) <= step]
+            startsides = geometry.sides(x, y, near)
+
+            def crossed(t):
+                ''' Index of a nearby line the particle has crossed after moving t, or -1'''
+                px, py = x + t * dx, y + t * dy
+                changed = near[geometry.sides(px, py, near) * startsides < 0]
+                return changed[0] if len(changed) else -1
+
+            if len(near) == 0 or crossed(step) < 0:
+                x += step * dx
+                y += step * dy
+                travelled += step
+                continue
+
+            # Collision somewhere in the step, narrow it down by bisection
+            low, high = 0, step
+            while high - low > tolerance:
+                middle = (low + high) / 2
+                if crossed(middle) >= 0:
+                    high = middle
+                else:
+                    low = middle
+            line = int(crossed(high))
+            nx, ny = geometry.normal(line, x + low * dx, y + low * dy)
+            ismirror = geometry.is_mirror(line)
+            # Medium on the other side of the surface, which the end of the bisection is just past
+            newn = None if ismirror else geometry.index_at(x + high * dx, y + high * dy)
+            newdx, newdy, currn, event = interact(dx, dy, nx, ny, currn, ismirror, newn)
+            # A beam passing through carries on from just past the surface and a reflected one from just before it,
+            # so it is on the right side of curved surfaces that it could hit again straight away
+            hit = high if event == "refract" else low
+            x += hit * dx
+            y += hit * dy
+            travelled += hit
+            dx, dy = newdx, newdy
+            # Straight lines can't be hit twice in a row
+            lastline = line if line < geometry.count else -1
+            path.add((x,y), travelled / PARTICLE_STEP * self.decayincr, direction_angle(dx, dy), currn, event)
+
+        # Finish at the edge of the screen or where the beam fades
+        stopt = min(edge_distance(x, y, dx, dy, width, height), maxlength - travelled)
+        travelled += stopt
+        path.add((x + stopt*dx, y + stopt*dy), travelled / PARTICLE_STEP * self.decayincr, direction_angle(dx, dy), currn, "end")
+
+        path.tests += geometry.tests - geometrytests
+        path.tracetime = time.perf_counter() - starttime
+        return path
+
+class CollimatedBeam(Laser):
+
+    ''' Object for simulator. A beam width wide of count parallel rays, coming out of the pointer like a Laser'''
+
+    batched = True
+    kind = "collimated"
+
+    def __init__(self, center, rot=0, width=40, count=20, decayincr=0.5, on=True, spectrum=None, fresnel=False):
+        super().__init__(center, rot, decayincr, on, spectrum, fresnel)
+        # Width of the pointer image is already self.width
+        self.beamwidth = width
+        self.count = count
+
+    def rays(self):
+        return collimated_rays(self.emission_point(), self.rotdeg, self.beamwidth, self.count)
+
+class FanSource(Laser):
+
+    ''' Object for simulator. count rays spreading out from the tip of the pointer over an angle of spread degrees'''
+
+    batched = True
+    kind = "fan"
+
+    def __init__(self, center, rot=0, spread=30, count=20, decayincr=0.5, on=True, spectrum=None, fresnel=False):
+        super().__init__(center, rot, decayincr, on, spectrum, fresnel)
+        self.spread = spread
+        self.count = count
+
+    def rays(self):
+        return fan_rays(self.emission_point(), self.rotdeg, self.spread, self.count)
+
+class PointSource(Laser):
+
+    ''' Object for simulator. count rays going out evenly in every direction from center, starting at rot'''
+
+    batched = True
+    kind = "point"
+
+    def __init__(self, center, rot=0, count=36, decayincr=0.5, on=True, spectrum=None, fresnel=False):
+        super().__init__(center, rot, decayincr, on, spectrum, fresnel)
+        self.count = count
+
+    def draw(self, screen, scale=1):
+        # Small bulb rather than a pointer as it shines every way
+        center = (self.center[0]*scale, self.center[1]*scale)
+        pygame.draw.circle(screen, RED, center, 6*scale)
+        pygame.draw.circle(screen, BLACK, center, 6*scale, max(1, round(scale)))
+
+    def rays(self):
+        return point_rays(self.center, self.rotdeg, self.count)
+
+# Light sources by the name used for them in scene files
+SOURCE_TYPES = {source.kind: source for source in (CollimatedBeam, FanSource, PointSource)}
+
+class BeamPath:
+
+    ''' Traced laser path. Stores each point where the beam changes direction and the state of the beam after it'''
+
+    def __init__(self, start, angle, n=1):
+        self.points = [start]
+        # Intensity uses the same scale as the particle engine, 0 is full red and 250 is white
+        self.intensities = [0]
+        # Direction of travel in radians, anticlockwise from north like Laser.rotrads
+        self.angles = [angle]
+        # Refractive index of the medium the beam is travelling through
+        self.ns = [n]
+        # What happened at each point, "start", "reflect", "refract", "tir" (total internal reflection) or "end"
+        self.events = ["start"]
+        # Share of the laser's power the beam has, less than 1 after partial reflections
+        self.powers = [1]
+        # Wavelength in nm for beams traced from a spectrum, and the colour the beam is drawn in before fading to white
+        self.wavelength = None
+        self.colour = RED
+        # Position in its BeamSet of the beam this one was partially reflected from
+        self.parent = None
+        # Bounding boxes of the lines of the path, worked out when first needed
+        self._segments = None
+
+        # Cost of tracing the path. Steps of the particle or rays cast, lines tested for collisions and seconds taken
+        self.steps = 0
+        self.tests = 0
+        self.tracetime = 0
+
+    # A single path is one ray and never prunes any
+    rays = 1
+    pruned = 0
+
+    @property
+    def bounces(self):
+        ''' Number of times the beam reflected or refracted'''
+        return len(self.events) - 2 if self.events[-1] == "end" else len(self.events) - 1
+
+    def add(self, point, intensity, angle, n, event, power=None):
+        ''' Add a point with the state of the beam after it. Power stays the same if not given'''
+        self.points.append(point)
+        self.intensities.append(intensity)
+        self.angles.append(angle)
+        self.ns.append(n)
+        self.events.append(event)
+        self.powers.append(self.powers[-1] if power is None else power)
+
+    def to_dict(self):
+        ''' Path as plain lists for JSON. Angles are converted to degrees anticlockwise from north like Laser.rotdeg'''
+        transitions = []
+        for i in range(1, len(self.ns)):
+            if self.ns[i] != self.ns[i-1]:
+                transitions.append({'point': list(self.points[i]), 'from': self.ns[i-1], 'to': self.ns[i]})
+        data = {
+            'points': [list(point) for point in self.points],
+            'intensities': list(self.intensities),
+            'angles': [math.degrees(angle) for angle in self.angles],
+            'n': list(self.ns),
+            'events': list(self.events),
+            'transitions': transitions
+            }
+        if self.wavelength is not None:
+            data['wavelength'] = self.wavelength
+        if any(power != 1 for power in self.powers):
+            data['powers'] = list(self.powers)
+        if self.parent is not None:
+            data['parent'] = self.parent
+        return data
+
+    def segments(self):
+        ''' Bounding box of each line of the path as arrays left, top, right, bottom, kept until the path changes'''
+        if self._segments is None or self._segments[0] != len(self.points):
+            points = np.asarray(self.points, dtype=float).reshape(-1, 2)
+            start, end = points[:-1], points[1:]
+            lower, upper = np.minimum(start, end), np.maximum(start, end)
+            self._segments = (len(self.points), (lower[:,0], lower[:,1], upper[:,0], upper[:,1]))
+        return self._segments[1]
+
+    def touches(self, box):
+        ''' Check if any part of the path could pass through box (left, top, right, bottom).
+        Compares the bounding box of each line of the path so can give false positives but never false negatives'''
+        left, top, right, bottom = box
+        segleft, segtop, segright, segbottom = self.segments()
+        return bool(((segleft <= right) & (segright >= left) & (segtop <= bottom) & (segbottom >= top)).any())
+
+    def box(self):
+        ''' Bounding box (left, top, right, bottom) of the whole path'''
+        points = np.asarray(self.points, dtype=float).reshape(-1, 2)
+        (left, top), (right, bottom) = points.min(axis=0), points.max(axis=0)
+        return float(left), float(top), float(right), float(bottom)
+
+class BeamSet:
+
+    ''' Several BeamPaths traced together from one laser, such as one for each wavelength of its spectrum or the tree of
+    rays split off by partial reflections. Has the same statistics and methods as a BeamPath so either can be stored,
+    drawn or saved'''
+
+    def __init__(self, paths):
+        self.paths = paths
+        # Lines tested and seconds taken tracing all the paths together
+        self.tests = 0
+        self.tracetime = 0
+        # Rays dropped for being too weak, rays not split off because of the depth or ray limits, and the deepest split
+        self.pruned = 0
+        self.capped = 0
+        self.depth = 0
+        # Bounding boxes of the lines of all the paths, worked out when first needed
+        self._segments = None
+
+    @property
+    def rays(self):
+        return len(self.paths)
+
+    @property
+    def steps(self):
+        return sum(path.steps for path in self.paths)
+
+    @property
+    def bounces(self):
+        return sum(path.bounces for path in self.paths)
+
+    def to_dict(self):
+        return {'paths': [path.to_dict() for path in self.paths],
+                'stats': {'rays': self.rays, 'pruned': self.pruned, 'capped': self.capped, 'depth': self.depth}}
+
+    def touches(self, box):
+        # Lines of every path are checked together
+        if self._segments is None:
+            segments = [path.segments() for path in self.paths]
+            self._segments = tuple(np.concatenate([segment[i] for segment in segments]) if segments else np.zeros(0)
+                                   for i in range(4))
+        left, top, right, bottom = box
+        segleft, segtop, segright, segbottom = self._segments
+        return bool(((segleft <= right) & (segright >= left) & (segtop <= bottom) & (segbottom >= top)).any())
+
+    def box(self):
+        # Nothing to cover if no rays were given out
+        if not self.paths:
+            return None
+        boxes = np.array([path.box() for path in self.paths], dtype=float).reshape(-1, 4)
+        return float(boxes[:,0].min()), float(boxes[:,1].min()), float(boxes[:,2].max()), float(boxes[:,3].max())
+
+def draw_path(screen, path, scale=1):
+    ''' Draws a traced beam or BeamSet fading from its colour to white, and paler for beams with less power. Each line
+    between points of the path is split into a few shorter lines that each cover FADE_STEP of intensity.
+    Positions and the width of the beam are multiplied by scale'''
+    if isinstance(path, BeamSet):
+        for subpath in path.paths:
+            draw_path(screen, subpath, scale)
+        return
+    width = max(1, round(3*scale))
+    for i in range(len(path.points) - 1):
+        (x1,y1), (x2,y2) = path.points[i], path.points[i+1]
+        x1, y1, x2, y2 = x1*scale, y1*scale, x2*scale, y2*scale
+        intensity1, intensity2 = path.intensities[i], path.intensities[i+1]
+        # Weaker beams are never darker than this
+        faintest = 250 * (1 - path.powers[i])
+        pieces = max(1, math.ceil((intensity2 - intensity1) / FADE_STEP))
+        for piece in range(pieces):
+            start = piece / pieces
+            end = (piece + 1) / pieces
+            # Colour from the middle of the piece
+            intensity = min(intensity1 + (intensity2 - intensity1) * (start + end) / 2, 250)
+            pygame.draw.line(screen, [max(channel, intensity, faintest) for channel in path.colour],
+                             (x1 + (x2-x1)*start, y1 + (y2-y1)*start), (x1 + (x2-x1)*end, y1 + (y2-y1)*end), width)
+
+def box_rect(box, margin=0):
+    ''' Smallest pygame Rect covering box (left, top, right, bottom), expanded by margin on each side'''
+    left, top, right, bottom = box
+    left, top = math.floor(left) - margin, math.floor(top) - margin
+    return pygame.Rect(left, top, math.ceil(right) + margin + 1 - left, math.ceil(bottom) + margin + 1 - top)
+
+def merge_rects(rects, limit=8):
+    ''' Combine overlapping rects so each area is only drawn once, and all of them into one if there are still more
+    than limit'''
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        # Taking in one rect can make it overlap others already checked, so check them all again
+        i = 0
+        while i < len(merged):
+            if rect.colliderect(merged[i]):
+                rect.union_ip(merged.pop(i))
+                i = 0
+            else:
+                i += 1
+        merged.append(rect)
+    if len(merged) > limit:
+        return [merged[0].unionall(merged[1:])]
+    return merged
+
+## Ray helpers
+def direction_angle(dx, dy):
+    ''' Angle of direction vector, anticlockwise from north and 0 <= angle < 2pi'''
+    return math.atan2(-dx, -dy) % (2 * PI)
+
+def edge_distance(x, y, dx, dy, width, height):
+    ''' Distance along ray from (x,y) inside the screen to the edge of the screen'''
+    t = math.inf
+    if dx > 0:
+        t = min(t, (width - x) / dx)
+    elif dx < 0:
+        t = min(t, -x / dx)
+    if dy > 0:
+        t = min(t, (height - y) / dy)
+    elif dy < 0:
+        t = min(t, -y / dy)
+    return t
+
+def edge_distances(x, y, dx, dy, width, height):
+    ''' edge_distance for arrays of rays'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tx = np.where(dx > 0, (width - x) / dx, np.where(dx < 0, -x / dx, math.inf))
+        ty = np.where(dy > 0, (height - y) / dy, np.where(dy < 0, -y / dy, math.inf))
+    return np.minimum(tx, ty)
+
+def nearest_surface(x, y, dx, dy, objects, skip=None):
+    ''' Checks each surface of the mirrors and blocks in objects in turn for the nearest one hit by the ray,
+    ignoring the line skip. Arcs are never skipped as they can be hit twice in a row.
+    Returns distance, surface and the object it belongs to'''
+    nearestt = math.inf
+    nearestsurface = None
+    nearestobj = None
+    for obj in objects:
+        for surface in obj.surfaces:
+            if surface is skip and isinstance(surface, Line):
+                continue
+            t = surface.intersect(x, y, dx, dy)
+            if t is not None and t < nearestt:
+                nearestt, nearestsurface, nearestobj = t, surface, obj
+    return nearestt, nearestsurface, nearestobj
+
+def past_surface(x, y, dx, dy, nx, ny):
+    ''' Point just past a surface with unit normal (nx,ny) through (x,y), on the side a beam going in direction (dx,dy)
+    is heading to. Works on arrays'''
+    side = np.where(dx*nx + dy*ny >= 0, MEDIUM_EPSILON, -MEDIUM_EPSILON)
+    return x + side*nx, y + side*ny
+
+def block_at(x, y, blocks, outline=False):
+    ''' Block that point (x,y) is in, or None for air. Where blocks overlap the last one is on top, as it is drawn.
+    With outline set, blocks are taken to be the outline through their points like the lines the particle engine uses'''
+    for block in reversed(blocks):
+        left, top, right, bottom = block.box
+        if not (left <= x <= right and top <= y <= bottom):
+            continue
+        inside = block.winding(x, y) != 0 if outline else block.contains(x, y)
+        if inside:
+            return block
+    return None
+
+def interact(dx, dy, nx, ny, currn, ismirror, newn):
+    ''' Beam travelling in direction (dx,dy) through refractive index currn hits a surface with unit normal (nx,ny)
+    of a mirror, or of a block with refractive index newn on the far side of it.
+    Returns new direction, refractive index and event'''
+    if ismirror:
+        dx, dy = reflect(dx, dy, nx, ny)
+        return dx, dy, currn, "reflect"
+
+    # Passing through wall of block so refracting
+    refracted = refract(dx, dy, nx, ny, currn, newn)
+    if refracted is None:
+        # Total internal reflection, staying in block
+        dx, dy = reflect(dx, dy, nx, ny)
+        return dx, dy, currn, "tir"
+    dx, dy = refracted
+    return dx, dy, newn, "refract"
+
+def interact_batch(dx, dy, nx, ny, currn, ismirror, newn):
+    ''' interact for arrays of beams. Returns arrays of new directions and refractive indices, and of events'''
+    dot = dx*nx + dy*ny
+    reflecteddx, reflecteddy = dx - 2*dot*nx, dy - 2*dot*ny
+
+    # Mirrors keep the current refractive index
+    newn = np.where(ismirror, currn, newn)
+    # Normal must point back towards the incoming ray
+    cosi = np.abs(dot)
+    sign = np.where(dot > 0, -1.0, 1.0)
+    ratio = currn / newn
+    k = 1 - ratio**2 * (1 - cosi**2)
+    tir = (k < 0) & ~ismirror
+    c = ratio * cosi - np.sqrt(np.maximum(k, 0))
+    refracteddx, refracteddy = ratio*dx + c*sign*nx, ratio*dy + c*sign*ny
+
+    reflected = ismirror | tir
+    events = np.where(ismirror, "reflect", np.where(tir, "tir", "refract"))
+    return (np.where(reflected, reflecteddx, refracteddx), np.where(reflected, reflecteddy, refracteddy),
+            np.where(reflected, currn, newn), events)
+
+@functools.lru_cache(maxsize=1024)
+def wavelength_colour(wavelength):
+    ''' Approximate colour of light of wavelength in nm, as an RGB tuple'''
+    if 380 <= wavelength < 440:
+        red, green, blue = (440 - wavelength) / 60, 0, 1
+    elif 440 <= wavelength < 490:
+        red, green, blue = 0, (wavelength - 440) / 50, 1
+    elif 490 <= wavelength < 510:
+        red, green, blue = 0, 1, (510 - wavelength) / 20
+    elif 510 <= wavelength < 580:
+        red, green, blue = (wavelength - 510) / 70, 1, 0
+    elif 580 <= wavelength < 645:
+        red, green, blue = 1, (645 - wavelength) / 65, 0
+    elif 645 <= wavelength <= 780:
+        red, green, blue = 1, 0, 0
+    else:
+        # Can't be seen, draw as black
+        return BLACK
+    # Dimmer towards the ends of the visible range
+    if wavelength < 420:
+        factor = 0.3 + 0.7 * (wavelength - 380) / 40
+    elif wavelength > 700:
+        factor = 0.3 + 0.7 * (780 - wavelength) / 80
+    else:
+        factor = 1
+    return tuple(int(round(255 * (channel * factor) ** 0.8)) for channel in (red, green, blue))
+
+def trace_batch(bounds, geometry, x, y, dx, dy, wavelengths=None, maxlength=math.inf, maxbounces=500,
+                fresnel=False, threshold=FRESNEL_THRESHOLD, maxdepth=FRESNEL_MAXDEPTH, maxrays=FRESNEL_MAXRAYS,
+                detectors=(), keep=True):
+    ''' Traces many rays together like Laser.trace_ray, finding the nearest hit for every ray still travelling with one set
+    of array operations per bounce. Rays start at arrays x, y with unit directions dx, dy. wavelengths in nm are used for
+    blocks with a dispersion model, or if None each block's n is used. Rays fade to white after travelling maxlength.
+
+    With fresnel set each refraction also splits off a reflected ray, sharing the power between them by the Fresnel
+    equations. The rays form a tree traced breadth first, as every bounce moves all the rays still travelling and the
+    new reflected rays join in from the next. Rays with less than threshold of the starting power are pruned, and no
+    more rays are split off once maxdepth splits deep or when there are maxrays.
+
+    Every stretch of every ray is added to each of detectors as it is traced. When only the detectors are wanted
+    keep can be turned off so no paths are made, which is much quicker for many rays.
+    Returns a BeamSet of a BeamPath for each ray, with split off rays after the starting ones, or no paths without keep'''
+    x, y, dx, dy = (np.array(values, dtype=float) for values in (x, y, dx, dy))
+    count = len(x)
+    if wavelengths is not None:
+        wavelengths = np.broadcast_to(np.asarray(wavelengths, dtype=float), (count,))
+
+    paths = []
+    for ray in range(count if keep else 0):
+        path = BeamPath((float(x[ray]), float(y[ray])), direction_angle(dx[ray], dy[ray]))
+        if wavelengths is not None:
+            path.wavelength = float(wavelengths[ray])
+            path.colour = wavelength_colour(path.wavelength)
+        paths.append(path)
+    beams = BeamSet(paths)
+
+    width, height = bounds
+    # Refractive index of each object for the wavelength of each starting ray
+    objectn = geometry.refractive_indices(wavelengths, count)
+    # Rays start in whichever block they are in, or air
+    currn = np.ones(count)
+    if geometry.objects:
+        media = geometry.media(x, y)
+        currn = np.where(media >= 0, objectn[media, np.arange(count)], 1.0)
+    for path, n in zip(paths, currn.tolist()):
+        path.ns[0] = n
+    travelled = np.zeros(count)
+    steps = np.zeros(count, dtype=int)
+    # Line each ray last hit, skipped like in trace_ray
+    lastline = np.full(count, -1, dtype=np.intp)
+    # Share of the starting power, how many splits deep each ray is and the starting ray it came from
+    power = np.ones(count)
+    depth = np.zeros(count, dtype=int)
+    origin = np.arange(count)
+    # Indices of the rays still travelling, to begin with those that start on the screen
+    active = np.nonzero((0 < x) & (x < width) & (0 < y) & (y < height))[0]
+
+    def record(rays, pointx, pointy, events):
+        ''' Add a point to the path of each of rays, working out everything else about them for all at once'''
+        if not keep:
+            return
+        intensities = travelled[rays] / maxlength * 250
+        angles = np.arctan2(-dx[rays], -dy[rays]) % (2 * PI)
+        for ray, point, intensity, angle, n, event, share in zip(rays.tolist(), zip(pointx.tolist(), pointy.tolist()),
+                                                                 intensities.tolist(), angles.tolist(), currn[rays].tolist(),
+                                                                 events.tolist(), power[rays].tolist()):
+            paths[ray].add(point, intensity, angle, n, event, share)
+
+    for bounce in range(maxbounces):
+        if len(active) == 0:
+            break
+        steps[active] += 1
+        t, surfaces = geometry.nearest_hits(x[active], y[active], dx[active], dy[active], lastline[active])
+
+        # Rays stop at the edge of the screen or when they have faded
+        stopt = np.minimum(edge_distances(x[active], y[active], dx[active], dy[active], width, height),
+                           maxlength - travelled[active])
+        stopping = t >= stopt
+        if detectors:
+            # Stretch each ray travels this bounce, with its power fading along it
+            length = np.minimum(t, stopt)
+            startx, starty, share = x[active], y[active], power[active]
+            fade1 = share * np.clip(1 - travelled[active] / maxlength, 0, 1)
+            fade2 = share * np.clip(1 - (travelled[active] + length) / maxlength, 0, 1)
+            for detector in detectors:
+                detector.record(startx, starty, startx + length*dx[active], starty + length*dy[active], fade1, fade2)
+        if stopping.any():
+            ended, stop = active[stopping], stopt[stopping]
+            travelled[ended] += stop
+            record(ended, x[ended] + stop*dx[ended], y[ended] + stop*dy[ended], np.full(len(ended), "end"))
+
+        # Move the others to what they hit
+        active, t, surfaces = active[~stopping], t[~stopping], surfaces[~stopping]
+        x[active] += t * dx[active]
+        y[active] += t * dy[active]
+        travelled[active] += t
+        lastline[active] = np.where(surfaces < geometry.count, surfaces, -1)
+
+        nx, ny = geometry.surface_normals(surfaces, x[active], y[active])
+        ismirror = geometry.surface_owners(surfaces)[0]
+        incomingdx, incomingdy, incomingn = dx[active], dy[active], currn[active]
+        # Refractive index of whatever is on the other side of each surface
+        media = geometry.media(*past_surface(x[active], y[active], incomingdx, incomingdy, nx, ny))
+        newn = np.where(media >= 0, objectn[media, origin[active]], 1.0)
+        dx[active], dy[active], currn[active], events = interact_batch(incomingdx, incomingdy, nx, ny, incomingn,
+                                                                       ismirror, newn)
+        if fresnel:
+            # Share of each refracted ray's power that is reflected instead
+            refracted = events == "refract"
+            reflectance = fresnel_reflectance(np.abs(incomingdx*nx + incomingdy*ny), np.abs(dx[active]*nx + dy[active]*ny),
+                                              incomingn, currn[active])
+            splitpower = np.where(refracted, power[active] * reflectance, 0)
+            power[active] -= splitpower
+        record(active, x[active], y[active], events)
+        if not fresnel:
+            continue
+
+        # Split off reflected rays that are strong enough, as long as the tree isn't too deep or big
+        strong = splitpower >= threshold
+        beams.pruned += int(np.count_nonzero(refracted & ~strong))
+        allowed = np.nonzero(strong & (depth[active] < maxdepth))[0]
+        beams.capped += int(np.count_nonzero(strong)) - len(allowed)
+        room = max(maxrays - len(x), 0)
+        beams.capped += max(len(allowed) - room, 0)
+        allowed = allowed[:room]
+        parents = active[allowed]
+
+        # Rays passing through that are now too weak stop here
+        weak = power[active] < threshold
+        beams.pruned += int(np.count_nonzero(weak))
+        active = active[~weak]
+
+        if len(parents):
+            childdx, childdy = reflect(incomingdx[allowed], incomingdy[allowed], nx[allowed], ny[allowed])
+            first = len(x)
+            x = np.concatenate((x, x[parents]))
+            y = np.concatenate((y, y[parents]))
+            dx = np.concatenate((dx, childdx))
+            dy = np.concatenate((dy, childdy))
+            currn = np.concatenate((currn, incomingn[allowed]))
+            travelled = np.concatenate((travelled, travelled[parents]))
+            steps = np.concatenate((steps, np.zeros(len(parents), dtype=int)))
+            lastline = np.concatenate((lastline, lastline[parents]))
+            power = np.concatenate((power, splitpower[allowed]))
+            depth = np.concatenate((depth, depth[parents] + 1))
+            origin = np.concatenate((origin, origin[parents]))
+            for ray, parent in enumerate(parents.tolist() if keep else (), first):
+                path = BeamPath((float(x[ray]), float(y[ray])), direction_angle(dx[ray], dy[ray]), float(currn[ray]))
+                path.intensities[0] = float(travelled[ray] / maxlength * 250)
+                path.powers[0] = float(power[ray])
+                path.parent = parent
+                path.wavelength = paths[parent].wavelength
+                path.colour = paths[parent].colour
+                paths.append(path)
+            beams.depth = max(beams.depth, int(depth[first:].max()))
+            active = np.concatenate((active, np.arange(first, len(x))))
+
+    for path, count in zip(paths, steps.tolist()):
+        path.steps = count
+    return beams
+
+def fresnel_reflectance(cosi, cost, n1, n2):
+    ''' Share of unpolarised light reflected going from refractive index n1 to n2, from the cosines of the angles of
+    incidence and refraction. Works on arrays'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (n1*cosi - n2*cost) / (n1*cosi + n2*cost)
+        p = (n1*cost - n2*cosi) / (n1*cost + n2*cosi)
+        # Everything is reflected at grazing incidence
+        return np.nan_to_num((s*s + p*p) / 2, nan=1.0)
+
+def collimated_rays(center, rot, width, count):
+    ''' Starting points and unit directions of count parallel rays spread evenly across a beam width wide, centred on
+    center and pointing at angle rot in degrees anticlockwise from north like a Laser. Returns arrays x, y, dx, dy'''
+    rotrads = math.radians(rot)
+    offsets = (np.arange(count) + 0.5) / count * width - width / 2 if count else np.zeros(0)
+    # Across the beam is perpendicular to the direction of travel
+    x = center[0] + offsets * math.cos(rotrads)
+    y = center[1] - offsets * math.sin(rotrads)
+    return x, y, np.full(count, -math.sin(rotrads)), np.full(count, -math.cos(rotrads))
+
+def fan_rays(center, rot, spread, count):
+    ''' Starting points and unit directions of count rays from center, spread evenly over an angle of spread degrees
+    around rot in degrees anticlockwise from north like a Laser. Returns arrays x, y, dx, dy'''
+    angles = np.radians(rot + ((np.arange(count) + 0.5) / count - 0.5) * spread) if count else np.zeros(0)
+    return np.full(count, float(center[0])), np.full(count, float(center[1])), -np.sin(angles), -np.cos(angles)
+
+def point_rays(center, rot, count):
+    ''' Starting points and unit directions of count rays from center going out evenly in every direction, the first
+    at angle rot in degrees anticlockwise from north like a Laser. Returns arrays x, y, dx, dy'''
+    return fan_rays(center, rot + 180 - 180 / count if count else rot, 360, count)
+
+def reflect(dx, dy, nx, ny):
+    ''' Reflect direction (dx,dy) in a surface with unit normal (nx,ny)'''
+    dot = dx*nx + dy*ny
+    return dx - 2*dot*nx, dy - 2*dot*ny
+
+def refract(dx, dy, nx, ny, currn, newn):
+    ''' Refract unit direction (dx,dy) through a surface with unit normal (nx,ny) using Snell's law.
+    Returns None for total internal reflection'''
+    cosi = -(dx*nx + dy*ny)
+    # Normal must point back towards the incoming ray
+    if cosi < 0:
+        nx, ny, cosi = -nx, -ny, -cosi
+    ratio = currn / newn
+    k = 1 - ratio**2 * (1 - cosi**2)
+    if k < 0:
+        return None
+    c = ratio * cosi - math.sqrt(k)
+    return ratio*dx + c*nx, ratio*dy + c*ny
 
 class Line:
 
@@ -335,57 +1414,392 @@ class Line:
 
         return distance
 
+    def intersect(self, x, y, dx, dy):
+        '''Calculate distance along ray from (x,y) in direction (dx,dy) to the line. None if the ray misses'''
+        # Cross product of directions, zero when parallel
+        denom = dx * self.linedy - dy * self.linedx
+        if denom == 0:
+            return None
+
+        relx = self.x1 - x
+        rely = self.y1 - y
+        # Distance along ray and ratio of how far along the line the intersection is
+        t = (relx * self.linedy - rely * self.linedx) / denom
+        u = (relx * dy - rely * dx) / denom
+
+        if t <= 0 or u < 0 or u > 1:
+            return None
+        return t
+
+    def normal(self, x=None, y=None):
+        '''Unit vector perpendicular to the line, the same at any point (x,y) on it'''
+        length = math.sqrt(self.r)
+        return -self.linedy / length, self.linedx / length
+
+class Arc:
+
+    ''' Helper class for curved surfaces. Part of a circle from angle start clockwise round to start + span,
+    angles are clockwise from north in radians like SemiCircleBlock.rot'''
+
+    def __init__(self, center, radius, start, span):
+        self.center = center
+        self.x, self.y = center
+        self.radius = radius
+        self.start = start % (2 * PI)
+        self.span = span
+
+    def point(self, angle):
+        '''Point on the circle at angle'''
+        return (self.x + self.radius * math.sin(angle), self.y - self.radius * math.cos(angle))
+
+    def contains(self, x, y):
+        '''Check if the direction of point (x,y) from the centre is within the arc'''
+        angle = math.atan2(x - self.x, self.y - y)
+        return (angle - self.start) % (2 * PI) <= self.span
+
+    def dist(self, point):
+        '''Calculate and return distance from point to arc'''
+        xp, yp = point
+        if self.contains(xp, yp):
+            return abs(math.hypot(xp - self.x, yp - self.y) - self.radius)
+        # Beyond the arc so closest to one of the ends
+        (x1,y1), (x2,y2) = self.point(self.start), self.point(self.start + self.span)
+        return min(math.hypot(x1 - xp, y1 - yp), math.hypot(x2 - xp, y2 - yp))
+
+    def intersect(self, x, y, dx, dy):
+        '''Calculate distance along ray from (x,y) in unit direction (dx,dy) to the arc. None if the ray misses.
+        Hits closer than ARC_EPSILON are ignored so a ray leaving the arc doesn't hit it again straight away'''
+        relx = x - self.x
+        rely = y - self.y
+        # Solving |rel + t*d| = radius, a quadratic in t
+        b = relx * dx + rely * dy
+        c = relx**2 + rely**2 - self.radius**2
+        disc = b*b - c
+        if disc < 0:
+            return None
+        root = math.sqrt(disc)
+        # Nearer crossing of the circle first
+        for t in (-b - root, -b + root):
+            if t > ARC_EPSILON and self.contains(x + t*dx, y + t*dy):
+                return t
+        return None
+
+    def normal(self, x, y):
+        '''Unit vector perpendicular to the arc at point (x,y) on it, pointing away from the centre'''
+        return (x - self.x) / self.radius, (y - self.y) / self.radius
+
+    def polyline(self, step=0.1):
+        '''Points along the arc no more than step radians apart, including both ends'''
+        pieces = max(1, math.ceil(self.span / step))
+        return [self.point(self.start + self.span * i / pieces) for i in range(pieces + 1)]
+
+class Cauchy:
+
+    ''' Dispersion model for a block, refractive index n = a + b/λ² + c/λ⁴ with wavelength λ in micrometres'''
+
+    model = "cauchy"
+    coefficientcount = 3
+
+    def __init__(self, a, b, c=0):
+        self.coefficients = (a, b, c)
+
+    def n(self, wavelengths):
+        ''' Refractive index at each of wavelengths, given in nm'''
+        a, b, c = self.coefficients
+        micrometres = np.asarray(wavelengths, dtype=float) / 1000
+        return a + b / micrometres**2 + c / micrometres**4
+
+class Sellmeier:
+
+    ''' Dispersion model for a block, refractive index n² = 1 + Σ bᵢλ²/(λ² - cᵢ) for i = 1 to 3 with
+    wavelength λ in micrometres'''
+
+    model = "sellmeier"
+    coefficientcount = 6
+
+    def __init__(self, b1, b2, b3, c1, c2, c3):
+        self.coefficients = (b1, b2, b3, c1, c2, c3)
+
+    def n(self, wavelengths):
+        ''' Refractive index at each of wavelengths, given in nm'''
+        b1, b2, b3, c1, c2, c3 = self.coefficients
+        squared = (np.asarray(wavelengths, dtype=float) / 1000) ** 2
+        return np.sqrt(1 + b1*squared / (squared - c1) + b2*squared / (squared - c2) + b3*squared / (squared - c3))
+
+# Dispersion models by name for reading scene files
+DISPERSION_MODELS = {model.model: model for model in (Cauchy, Sellmeier)}
+# Borosilicate crown glass, n = 1.5168 at 587.6 nm
+BK7 = Sellmeier(1.03961212, 0.231792344, 1.01046945, 0.00600069867, 0.0200179144, 103.560653)
+
+# Mirrors and blocks all have a list of surfaces, each a Line or Arc with intersect and normal methods, and an
+# interaction saying what happens to a beam hitting them. Curved ones are approximated by lines for the particle engine
+
 class Mirror:
 
     ''' Object for simulator. Acts like a double sided mirror'''
 
+    interaction = "reflect"
+    curved = False
+
     def __init__(self, pos1, pos2):
+        self.set_ends(pos1, pos2)
+
+    def set_ends(self, pos1, pos2):
+        ''' Move the ends of the mirror. A SceneGeometry holding it needs updating afterwards'''
         self.x1, self.y1 = pos1
         self.x2, self.y2 = pos2
         self.pos1 = pos1
         self.pos2 = pos2
         self.line = Line(pos1, pos2)
 
-    def draw(self, screen):
+    @property
+    def lines(self):
+        return [self.line]
+
+    @property
+    def surfaces(self):
+        return [self.line]
+
+    def draw(self, screen, scale=1):
         # Only thing to draw is one line
-        pygame.draw.line(screen, DARKGREEN, self.pos1, self.pos2, 5)
+        pygame.draw.line(screen, DARKGREEN, (self.x1*scale, self.y1*scale), (self.x2*scale, self.y2*scale), max(1, round(5*scale)))
+
+class CurvedMirror:
+
+    ''' Object for simulator. A double sided mirror curving between pos1 and pos2 with the given radius of curvature.
+    The centre of curvature is to the right of the way from pos1 to pos2 when radius is positive and to the left
+    when negative, so the mirror is concave from that side and convex from the other'''
+
+    interaction = "reflect"
+    curved = True
+
+    def __init__(self, pos1, pos2, radius):
+        self.x1, self.y1 = pos1
+        self.x2, self.y2 = pos2
+        self.pos1 = pos1
+        self.pos2 = pos2
+        self.radius = radius
+
+        chord = math.hypot(self.x2 - self.x1, self.y2 - self.y1)
+        if chord == 0 or abs(radius) < chord / 2:
+            raise ValueError("Curved mirror radius {} is too small to reach between its ends".format(radius))
+        # Centre of curvature is on the perpendicular bisector of the line between the ends
+        offset = math.copysign(math.sqrt(radius**2 - chord**2 / 4), radius) / chord
+        center = ((self.x1 + self.x2) / 2 - (self.y2 - self.y1) * offset, (self.y1 + self.y2) / 2 + (self.x2 - self.x1) * offset)
+
+        # Shorter way round the circle between the ends
+        angle1 = math.atan2(self.x1 - center[0], center[1] - self.y1)
+        angle2 = math.atan2(self.x2 - center[0], center[1] - self.y2)
+        if (angle2 - angle1) % (2 * PI) <= PI:
+            self.arc = Arc(center, abs(radius), angle1, (angle2 - angle1) % (2 * PI))
+        else:
+            self.arc = Arc(center, abs(radius), angle2, (angle1 - angle2) % (2 * PI))
+        self.points = self.arc.polyline()
+        # Lines approximating the curve
+        self.lines = [Line(point1, point2) for point1, point2 in zip(self.points, self.points[1:])]
+
+    @property
+    def surfaces(self):
+        return [self.arc]
+
+    def draw(self, screen, scale=1):
+        pygame.draw.lines(screen, DARKGREEN, False, [(x*scale, y*scale) for x, y in self.points], max(1, round(5*scale)))
+
+class Detector:
+
+    ''' Object for simulator. A line like a Mirror that beams pass straight through, measuring where they cross it.
+    Crossings are added up in a histogram of bins of equal length from pos1 to pos2, both as a count and as the power
+    of the beams, which is less for beams that have faded or been partially reflected'''
+
+    interaction = "detect"
+
+    def __init__(self, pos1, pos2, bins=100):
+        self.x1, self.y1 = pos1
+        self.x2, self.y2 = pos2
+        self.pos1 = pos1
+        self.pos2 = pos2
+        self.length = math.hypot(self.x2 - self.x1, self.y2 - self.y1)
+        if self.length == 0 or bins < 1:
+            raise ValueError("Detector needs a non zero length and at least one bin")
+        self.bins = bins
+        self.reset()
+
+    def reset(self):
+        ''' Clear the histogram'''
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.power = np.zeros(self.bins)
+
+    @property
+    def hits(self):
+        return int(self.counts.sum())
+
+    def record(self, x1, y1, x2, y2, weights1=1.0, weights2=None):
+        ''' Add the crossings of line segments from arrays (x1,y1) to (x2,y2). Each segment's power goes linearly from
+        weights1 at its start to weights2 at its end, or is weights1 all the way along. A segment ending on the detector
+        counts but one starting on it doesn't, so joined segments aren't counted twice'''
+        segmentdx, segmentdy = x2 - x1, y2 - y1
+        linedx, linedy = self.x2 - self.x1, self.y2 - self.y1
+        denom = segmentdx * linedy - segmentdy * linedx
+        relx, rely = self.x1 - x1, self.y1 - y1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Fraction of the way along the segment and along the detector of the crossing, like SceneGeometry.intersect
+            t = (relx * linedy - rely * linedx) / denom
+            u = (relx * segmentdy - rely * segmentdx) / denom
+        hit = (denom != 0) & (t > 0) & (t <= 1) & (u >= 0) & (u <= 1)
+        if weights2 is None:
+            weights2 = weights1
+        weights = np.broadcast_to(weights1 + (weights2 - weights1) * t, hit.shape)[hit]
+        bins = np.minimum((u[hit] * self.bins).astype(np.intp), self.bins - 1)
+        self.counts += np.bincount(bins, minlength=self.bins)
+        self.power += np.bincount(bins, weights, minlength=self.bins)
+
+    def record_path(self, path):
+        ''' Add the crossings of a traced BeamPath or every path of a BeamSet'''
+        if isinstance(path, BeamSet):
+            for subpath in path.paths:
+                self.record_path(subpath)
+            return
+        if len(path.points) < 2:
+            return
+        points = np.asarray(path.points, dtype=float)
+        # Beams are dimmer as they fade to white, so the power of each segment falls with intensity along it
+        powers = np.asarray(path.powers[:-1], dtype=float)
+        fade = np.clip(1 - np.asarray(path.intensities, dtype=float) / 250, 0, 1)
+        self.record(points[:-1,0], points[:-1,1], points[1:,0], points[1:,1], powers * fade[:-1], powers * fade[1:])
+
+    def profile(self):
+        ''' Distance of the middle of each bin from pos1, the number of crossings and the power in each bin,
+        and the irradiance as power per unit length'''
+        width = self.length / self.bins
+        positions = (np.arange(self.bins) + 0.5) * width
+        return positions, self.counts.copy(), self.power.copy(), self.power / width
+
+    def to_dict(self):
+        ''' Position of the detector and its histogram, for saving the results of a trace'''
+        positions, counts, power, irradiance = self.profile()
+        return {'pos1': list(self.pos1), 'pos2': list(self.pos2), 'bins': self.bins, 'positions': positions.tolist(),
+                'counts': counts.tolist(), 'power': power.tolist(), 'irradiance': irradiance.tolist()}
+
+    def save_profile(self, filename):
+        ''' Save the histogram as a CSV file with a row for each bin'''
+        with open(filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('position', 'count', 'power', 'irradiance'))
+            writer.writerows(zip(*(values.tolist() for values in self.profile())))
+
+    @property
+    def rect(self):
+        ''' Area of the screen the detector and its histogram are drawn in'''
+        return box_rect((min(self.x1, self.x2), min(self.y1, self.y2), max(self.x1, self.x2), max(self.y1, self.y2)), 42)
+
+    def draw(self, screen, scale=1):
+        # Histogram as bars out to the left of the way from pos1 to pos2, scaled to the fullest bin
+        x1, y1, x2, y2 = self.x1*scale, self.y1*scale, self.x2*scale, self.y2*scale
+        if self.power.max() > 0:
+            alongx, alongy = (x2 - x1) / self.bins, (y2 - y1) / self.bins
+            outx, outy = (self.y2 - self.y1) / self.length, -(self.x2 - self.x1) / self.length
+            heights = self.power / self.power.max() * 40 * scale
+            for i, height in enumerate(heights.tolist()):
+                if height > 0:
+                    corner1 = (x1 + i * alongx, y1 + i * alongy)
+                    corner2 = (corner1[0] + alongx, corner1[1] + alongy)
+                    pygame.draw.polygon(screen, LIGHTBLUE, [corner1, corner2, (corner2[0] + height * outx, corner2[1] + height * outy),
+                                                            (corner1[0] + height * outx, corner1[1] + height * outy)])
+        pygame.draw.line(screen, MEDIUMBLUE, (x1, y1), (x2, y2), max(1, round(3*scale)))
 
 class Block:
 
     ''' Object for simulator. A block with a different refractive index to air.'''
 
-    def __init__(self,points,n):
+    interaction = "refract"
+    curved = False
+
+    def __init__(self,points,n,dispersion=None):
         # Corners of shape
         self.points = points
         # Refractive index of block
         self.n = n
-
-        # Create list of lines connecting the points
-        self.lines = []
-        for i1 in range(len(points)):
-            i2 = i1 + 1
-            if i2 == len(points):
-                i2 = 0
-            self.lines.append( Line( points[i1], points[i2] ) )
-
-    def draw(self,screen):
+        # How the refractive index changes with wavelength, a Cauchy or Sellmeier model. Only used for lasers with a spectrum
+        self.dispersion = dispersion
+        self._lines = None
+        self._box = None
+        self._edges = None
+
+    @property
+    def box(self):
+        ''' Bounding box (left, top, right, bottom) of the block, worked out when first needed'''
+        if self._box is None:
+            self._box = object_box(self)
+        return self._box
+
+    def winding(self, x, y):
+        ''' Number of times the outline through the points goes round each point (x,y), non zero inside it.
+        Works on arrays of points'''
+        if self._edges is None:
+            points = np.asarray(self.points, dtype=float)
+            following = np.roll(points, -1, axis=0)
+            self._edges = points[:,0], points[:,1], following[:,0], following[:,1]
+        x1, y1, x2, y2 = self._edges
+        x = np.asarray(x, dtype=float)[..., None]
+        y = np.asarray(y, dtype=float)[..., None]
+        # Count the edges crossing the horizontal through each point on one side of it, up one way and down the other
+        cross = (x2 - x1) * (y - y1) - (x - x1) * (y2 - y1)
+        up = (y1 <= y) & (y2 > y) & (cross > 0)
+        down = (y1 > y) & (y2 <= y) & (cross < 0)
+        return up.sum(axis=-1) - down.sum(axis=-1)
+
+    def contains(self, x, y):
+        ''' Check if each point (x,y) is inside the block. Works on arrays of points'''
+        return self.winding(x, y) != 0
+
+    @property
+    def lines(self):
+        ''' Lines connecting the points, only created when first needed as SceneGeometry works from the points'''
+        if self._lines is None:
+            # Create list of lines connecting the points
+            self._lines = []
+            for i1 in range(len(self.points)):
+                i2 = i1 + 1
+                if i2 == len(self.points):
+                    i2 = 0
+                self._lines.append( Line( self.points[i1], self.points[i2] ) )
+        return self._lines
+
+    @property
+    def surfaces(self):
+        return self.lines
+
+    def index(self, wavelengths=None):
+        ''' Refractive index for light of each of wavelengths in nm, just n if no wavelengths or dispersion model are given'''
+        if wavelengths is None or self.dispersion is None:
+            return self.n
+        return self.dispersion.n(wavelengths)
+
+    def draw(self, screen, scale=1):
         # Solid fill and visible border
-        pygame.draw.polygon(screen, LIGHTGREY, self.points)
-        pygame.draw.lines(screen, MEDIUMGREY, True, self.points, 1)
+        points = [(x*scale, y*scale) for x, y in self.points]
+        pygame.draw.polygon(screen, LIGHTGREY, points)
+        pygame.draw.lines(screen, MEDIUMGREY, True, points, max(1, round(scale)))
 
 class SemiCircleBlock(Block):
 
     ''' Object for simulator. A semi-circular block.'''
 
-    def __init__(self,center,radius,rotation,n):
+    curved = True
+
+    def __init__(self,center,radius,rotation,n,dispersion=None):
+        self.n = n # Refracive index
+        self.dispersion = dispersion
+        self.reshape(center, radius, rotation)
+
+    def reshape(self, center, radius, rotation):
+        ''' Move, resize and turn the semicircle. A SceneGeometry holding it needs updating afterwards'''
         self.center = center
         self.x, self.y = center
         # When adding as an object, radius could be zero causing a div/0 error. Approximate with 1
         if radius == 0:
             radius = 1
         self.radius = radius
-
-        self.n = n # Refracive index
         self.rot = rotation # Clockwise from north in radians
 
         # Create a set of points to approximate curve of semicircle
@@ -400,26 +1814,800 @@ class SemiCircleBlock(Block):
             self.points.append((self.x + radius * math.sin(angle), self.y - radius * math.cos(angle)))
             angle += 0.1
 
-        # Create list of lines, curve is represented by many lines
-        self.lines = []
-        for i1 in range(len(self.points)):
-            i2 = i1 + 1
-            if i2 == len(self.points):
-                i2 = 0
-            self.lines.append(Line(self.points[i1], self.points[i2]))
+        # Curve is represented by many lines for drawing and the particle engine, created by Block when needed
+        self._lines = None
+        self._box = None
+        self._edges = None
+        # The exact curve and flat side, which the ray engines use in place of those lines
+        self.arc = Arc(center, radius, rotation, PI)
+        self.flat = Line(self.points[0], self.points[1])
+
+    @property
+    def surfaces(self):
+        return [self.flat, self.arc]
+
+    def contains(self, x, y):
+        ''' Check if each point (x,y) is inside the exact semicircle, within the radius and on the curved side of the flat'''
+        relx, rely = np.asarray(x) - self.x, np.asarray(y) - self.y
+        return (relx*relx + rely*rely <= self.radius**2) & (relx*math.cos(self.rot) + rely*math.sin(self.rot) >= 0)
+
+class Lens(Block):
+
+    ''' Object for simulator. A lens with two spherical faces of the same radius of curvature, biconvex when radius is
+    positive and biconcave when negative. thickness is measured through the middle and aperture is the height of the lens,
+    by default as tall as a biconvex lens can be or the radius of curvature for a biconcave one'''
+
+    curved = True
+
+    def __init__(self, center, radius, thickness, n=BLOCK_N, rotation=0, aperture=None, dispersion=None):
+        self.center = center
+        self.x, self.y = center
+        self.radius = radius
+        self.thickness = thickness
+        self.n = n
+        self.dispersion = dispersion
+        self.rot = rotation # Direction of the axis through the middle, clockwise from north in radians
+
+        size = abs(radius)
+        if radius == 0 or thickness <= 0:
+            raise ValueError("Lens needs a non zero radius and positive thickness")
+        if radius > 0:
+            if thickness > 2 * size:
+                raise ValueError("Lens of radius {} can't be {} thick".format(radius, thickness))
+            # Each centre of curvature is behind the opposite face
+            centerdist = size - thickness / 2
+            maxaperture = 2 * math.sqrt(size**2 - centerdist**2)
+        else:
+            centerdist = size + thickness / 2
+            maxaperture = 2 * size
+        if aperture is None:
+            aperture = maxaperture if radius > 0 else size
+        if aperture > maxaperture:
+            raise ValueError("Lens aperture {} is more than the largest possible, {}".format(aperture, maxaperture))
+        self.aperture = aperture
+
+        # Unit vectors along the axis and across the lens
+        ax, ay = math.sin(rotation), -math.cos(rotation)
+        px, py = math.cos(rotation), math.sin(rotation)
+        self.axis, self.across, self.centerdist = (ax, ay), (px, py), centerdist
+        halfangle = math.asin(aperture / 2 / size)
+        if radius > 0:
+            # Each face curves round its centre of curvature towards the way it faces
+            front = Arc((self.x - centerdist * ax, self.y - centerdist * ay), size, rotation - halfangle, 2 * halfangle)
+            back = Arc((self.x + centerdist * ax, self.y + centerdist * ay), size, rotation + PI - halfangle, 2 * halfangle)
+            edge = math.sqrt(size**2 - aperture**2 / 4) - centerdist
+        else:
+            front = Arc((self.x + centerdist * ax, self.y + centerdist * ay), size, rotation + PI - halfangle, 2 * halfangle)
+            back = Arc((self.x - centerdist * ax, self.y - centerdist * ay), size, rotation - halfangle, 2 * halfangle)
+            edge = centerdist - math.sqrt(size**2 - aperture**2 / 4)
+        self.arcs = [front, back]
+
+        # Going round the front face then the back face goes all the way round the lens
+        frontpoints, backpoints = front.polyline(), back.polyline()
+        self.edges = []
+        if edge > 1e-9:
+            # Flat rim at the top and bottom, half as far along the axis as the distance between faces at the rim
+            for side in (1, -1):
+                rim = (self.x + side * aperture / 2 * px, self.y + side * aperture / 2 * py)
+                self.edges.append(Line((rim[0] + edge * ax, rim[1] + edge * ay), (rim[0] - edge * ax, rim[1] - edge * ay)))
+        else:
+            # Faces meet at the rim
+            backpoints = backpoints[1:-1]
+        self.points = frontpoints + backpoints
+        self._lines = None
+        self._box = None
+        self._edges = None
+
+    @property
+    def surfaces(self):
+        return self.arcs + self.edges
+
+    def contains(self, x, y):
+        ''' Check if each point (x,y) is inside the exact lens. Within the aperture and inside both circles of the faces
+        for a biconvex lens, or outside both and between their centres for a biconcave one'''
+        relx, rely = np.asarray(x) - self.x, np.asarray(y) - self.y
+        along = relx * self.axis[0] + rely * self.axis[1]
+        across = relx * self.across[0] + rely * self.across[1]
+        size = abs(self.radius)
+        front = (along + self.centerdist)**2 + across**2 <= size**2
+        back = (along - self.centerdist)**2 + across**2 <= size**2
+        inside = abs(across) <= self.aperture / 2
+        if self.radius > 0:
+            return inside & front & back
+        return inside & ~front & ~back & (abs(along) <= self.centerdist)
+
+class SceneGeometry:
+
+    ''' Every line of the mirrors and blocks in a scene packed into NumPy arrays, so a ray or point
+    can be tested against all of them in one go. Objects can be added, replaced and removed without a full rebuild.
+    Point queries only test the lines a LineGrid finds near the point, and once there are indexthreshold lines
+    ray queries only test the lines in the grid cells along the ray.
+    Curved surfaces are kept as exact arcs in separate arrays. Surface indices number the lines from 0
+    and then the arcs from count, so arc k is surface count + k.'''
+
+    def __init__(self, capacity=64, cellsize=40, indexthreshold=1500):
+        # Objects in the order they were added, with where their lines start in the arrays and how many there are
+        self.objects = []
+        self.starts = []
+        self.counts = []
+
+        # Number of lines currently stored
+        self.count = 0
+        self._allocate(capacity)
+
+        # Increases on every change so anything traced against the geometry knows when it is out of date
+        self.version = 0
+        # Total number of lines tested by queries, for profiling
+        self.tests = 0
+
+        # Spatial index of the lines, below the threshold a single call over every line is quicker for rays
+        self.grid = LineGrid(cellsize)
+        self.indexthreshold = indexthreshold
+        self.batchsize = 32
+
+        # Bounding boxes of the objects for containment queries, rebuilt when the version changes
+        self._boxes = None
+        self._boxversion = -1
+
+        self._update_arcs()
+
+    def _allocate(self, capacity):
+        ''' Create arrays with room for capacity lines, keeping any lines already stored'''
+        old = getattr(self, 'x1', None)
+        self.capacity = capacity
+        arrays = {}
+        for name in ('x1', 'y1', 'x2', 'y2', 'linedx', 'linedy', 'r'):
+            arrays[name] = np.zeros(capacity)
+        arrays['owner'] = np.zeros(capacity, dtype=np.intp)
+        arrays['mirror'] = np.zeros(capacity, dtype=bool)
+        for name, array in arrays.items():
+            if old is not None:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+
+    def _write(self, start, slot, obj):
+        ''' Fill in lines of obj starting at index start'''
+        x1, y1, x2, y2 = object_lines(obj)
+        end = start + len(x1)
+        self.x1[start:end] = x1
+        self.y1[start:end] = y1
+        self.x2[start:end] = x2
+        self.y2[start:end] = y2
+        # Change in x and y along the line, and r as used in Line.dist
+        self.linedx[start:end] = x2 - x1
+        self.linedy[start:end] = y2 - y1
+        self.r[start:end] = self.linedx[start:end] ** 2 + self.linedy[start:end] ** 2
+        self.owner[start:end] = slot
+        for index in range(start, end):
+            self.grid.insert(index, self.x1[index], self.y1[index], self.x2[index], self.y2[index])
+        self.mirror[start:end] = obj.interaction == "reflect"
+
+    def _update_arcs(self):
+        ''' Rebuild the arc arrays from the objects. There are only ever a few arcs so they aren't edited in place'''
+        arcs = [(slot, arc) for slot, obj in enumerate(self.objects) for arc in object_arcs(obj)]
+        self.arccount = len(arcs)
+        self.arcowner = np.array([slot for slot, arc in arcs], dtype=np.intp)
+        for name, attribute in (('arcx', 'x'), ('arcy', 'y'), ('arcr', 'radius'), ('arcstart', 'start'), ('arcspan', 'span')):
+            setattr(self, name, np.array([getattr(arc, attribute) for slot, arc in arcs], dtype=float))
+        self.arcmirror = np.array([self.objects[slot].interaction == "reflect" for slot, arc in arcs], dtype=bool)
+        # Ends of each arc, for distances to points beyond them
+        end = self.arcstart + self.arcspan
+        self.arcx1 = self.arcx + self.arcr * np.sin(self.arcstart)
+        self.arcy1 = self.arcy - self.arcr * np.cos(self.arcstart)
+        self.arcx2 = self.arcx + self.arcr * np.sin(end)
+        self.arcy2 = self.arcy - self.arcr * np.cos(end)
+
+    def _slot(self, obj):
+        ''' Position of obj in the object list, checking the last object first as that is usually the one being edited'''
+        for slot in range(len(self.objects) - 1, -1, -1):
+            if self.objects[slot] is obj:
+                return slot
+        raise ValueError("Object is not in the scene geometry")
+
+    def _resize(self, slot, newcount):
+        ''' Shift the lines after slot so that it has room for newcount lines'''
+        shift = newcount - self.counts[slot]
+        if shift == 0:
+            return
+        start = self.starts[slot]
+        for index in range(start, start + self.counts[slot]):
+            self.grid.remove(index)
+        if self.count + shift > self.capacity:
+            self._allocate(max(2 * self.capacity, self.count + shift))
+        tail = self.starts[slot] + self.counts[slot]
+        for name in ('x1', 'y1', 'x2', 'y2', 'linedx', 'linedy', 'r', 'owner', 'mirror'):
+            array = getattr(self, name)
+            array[tail+shift:self.count+shift] = array[tail:self.count].copy()
+        self.count += shift
+        self.counts[slot] = newcount
+        for later in range(slot + 1, len(self.objects)):
+            self.starts[later] += shift
+
+        # Lines after slot have moved to new indices so the grid needs to be rebuilt
+        if tail < self.count - shift:
+            self.grid.clear()
+            for index in range(self.count):
+                if not start <= index < start + newcount:
+                    self.grid.insert(index, self.x1[index], self.y1[index], self.x2[index], self.y2[index])
+
+    def add(self, obj):
+        ''' Append the lines and arcs of a Mirror or Block'''
+        slot = len(self.objects)
+        self.objects.append(obj)
+        self.starts.append(self.count)
+        self.counts.append(0)
+        self._resize(slot, line_count(obj))
+        self._write(self.starts[slot], slot, obj)
+        if object_arcs(obj):
+            self._update_arcs()
+        self.version += 1
+
+    def replace(self, old, new):
+        ''' Swap the lines of object old for those of new, only rewriting the arrays from old onwards'''
+        slot = self._slot(old)
+        self.objects[slot] = new
+        self._resize(slot, line_count(new))
+        self._write(self.starts[slot], slot, new)
+        if object_arcs(old) or object_arcs(new):
+            self._update_arcs()
+        # Bounding boxes only need the one row changing
+        current = self._boxversion == self.version
+        self.version += 1
+        if current:
+            self._boxes[slot] = self._box_of(new)
+            self._boxversion = self.version
+
+    def update(self, obj):
+        ''' Rewrite the lines of obj after it has been changed in place'''
+        self.replace(obj, obj)
+
+    def snapshot(self):
+        ''' Copy of the geometry that isn't affected by later changes to it or to its objects, so it can be traced
+        against on another thread. Objects are copied without copying what they hold, as objects changed in place
+        replace what they hold rather than altering it'''
+        geometry = copy.copy(self)
+        geometry.objects = [copy.copy(obj) for obj in self.objects]
+        geometry.starts = list(self.starts)
+        geometry.counts = list(self.counts)
+        # Lines are written into the arrays in place, arcs are always rebuilt as new arrays
+        for name in ('x1', 'y1', 'x2', 'y2', 'linedx', 'linedy', 'r', 'owner', 'mirror'):
+            setattr(geometry, name, getattr(self, name).copy())
+        geometry.grid = self.grid.copy()
+        if self._boxes is not None:
+            geometry._boxes = self._boxes.copy()
+        return geometry
+
+    def remove(self, obj):
+        slot = self._slot(obj)
+        self._resize(slot, 0)
+        del self.objects[slot], self.starts[slot], self.counts[slot]
+        # Owners after the removed object move down one place
+        if slot < len(self.objects):
+            self.owner[self.starts[slot]:self.count] -= 1
+        if self.arccount:
+            self._update_arcs()
+        self.version += 1
+
+    def distances(self, x, y, lines=None):
+        ''' Distance from point (x,y) to every line, or only those at the indices in lines. Same formula as Line.dist'''
+        if lines is None:
+            lines = slice(0, self.count)
+        x1, y1, linedx, linedy = self.x1[lines], self.y1[lines], self.linedx[lines], self.linedy[lines]
+        self.tests += len(x1)
+        u = ((x - x1) * linedx + (y - y1) * linedy) / self.r[lines]
+        np.clip(u, 0, 1, out=u)
+        return np.hypot(x1 + u * linedx - x, y1 + u * linedy - y)
+
+    def arc_distances(self, x, y):
+        ''' Distance from point (x,y) to every arc, same as Arc.dist'''
+        self.tests += self.arccount
+        relx = x - self.arcx
+        rely = y - self.arcy
+        angle = np.arctan2(relx, -rely)
+        alongside = (angle - self.arcstart) % (2 * PI) <= self.arcspan
+        ends = np.minimum(np.hypot(self.arcx1 - x, self.arcy1 - y), np.hypot(self.arcx2 - x, self.arcy2 - y))
+        return np.where(alongside, np.abs(np.hypot(relx, rely) - self.arcr), ends)
+
+    def surface_distances(self, x, y):
+        ''' Distance from point (x,y) to every surface, indexed by surface index'''
+        if self.arccount == 0:
+            return self.distances(x, y)
+        return np.concatenate((self.distances(x, y), self.arc_distances(x, y)))
+
+    def sides(self, x, y, surfaces):
+        ''' Which side of each surface at the indices in surfaces point (x,y) is on. The sign of the cross product
+        for lines, and whether it is outside (1) or inside (-1) the circle for arcs'''
+        self.tests += len(surfaces)
+        isarc = surfaces >= self.count
+        lines = surfaces[~isarc]
+        arcs = surfaces[isarc] - self.count
+        result = np.empty(len(surfaces))
+        result[~isarc] = np.sign(self.linedx[lines] * (y - self.y1[lines]) - self.linedy[lines] * (x - self.x1[lines]))
+        result[isarc] = np.sign(np.hypot(x - self.arcx[arcs], y - self.arcy[arcs]) - self.arcr[arcs])
+        return result
+
+    def any_within(self, x, y, radius):
+        ''' Check if any surface is within radius of point (x,y)'''
+        if self.count:
+            lines = self.grid.near_point(x, y, radius)
+            if len(lines) > 0 and self.distances(x, y, lines).min() <= radius:
+                return True
+        # Arcs are allowed extra room for the lines approximating them, which the particle engine collides with
+        return self.arccount > 0 and bool((self.arc_distances(x, y) <= radius + ARC_SAGITTA * self.arcr).any())
+
+    def intersect(self, x, y, dx, dy, lines=None):
+        ''' Distance along ray from (x,y) in direction (dx,dy) to every line, or only those at the indices in lines.
+        inf for lines it misses. Same as Line.intersect. Columns of rays can be given to get a row for each ray'''
+        if lines is None:
+            lines = slice(0, self.count)
+        linedx, linedy = self.linedx[lines], self.linedy[lines]
+        denom = dx * linedy - dy * linedx
+        self.tests += denom.size
+        relx = self.x1[lines] - x
+        rely = self.y1[lines] - y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (relx * linedy - rely * linedx) / denom
+            u = (relx * dy - rely * dx) / denom
+        hit = (denom != 0) & (t > 0) & (u >= 0) & (u <= 1)
+        return np.where(hit, t, math.inf)
+
+    def arc_intersect(self, x, y, dx, dy):
+        ''' Distance along ray from (x,y) in unit direction (dx,dy) to every arc, inf for arcs it misses.
+        Same as Arc.intersect. Columns of rays can be given to get a row for each ray'''
+        relx = x - self.arcx
+        rely = y - self.arcy
+        b = relx * dx + rely * dy
+        self.tests += b.size
+        disc = b*b - (relx**2 + rely**2 - self.arcr**2)
+        root = np.sqrt(np.maximum(disc, 0))
+        t = np.full(b.shape, math.inf)
+        # Nearer crossing of each circle first, so the first one on the arc is kept
+        for crossing in (-b - root, -b + root):
+            angle = np.arctan2(relx + crossing * dx, -(rely + crossing * dy))
+            hit = (disc >= 0) & (crossing > ARC_EPSILON) & ((angle - self.arcstart) % (2 * PI) <= self.arcspan)
+            t = np.where(hit & (t == math.inf), crossing, t)
+        return t
+
+    def surface_intersect(self, x, y, dx, dy, surfaces):
+        ''' Distance along ray from (x,y) in unit direction (dx,dy) to each surface at the indices in surfaces,
+        inf for those it misses'''
+        isarc = surfaces >= self.count
+        result = np.empty(len(surfaces))
+        result[~isarc] = self.intersect(x, y, dx, dy, surfaces[~isarc])
+        if isarc.any():
+            result[isarc] = self.arc_intersect(x, y, dx, dy)[surfaces[isarc] - self.count]
+        return result
+
+    def nearest_hit(self, x, y, dx, dy, skip=-1):
+        ''' Distance to and surface index of the nearest surface hit by the ray, ignoring line index skip.
+        (inf, -1) if none are hit'''
+        if skip is None:
+            skip = -1
+        nearestt, nearest = math.inf, -1
+        if self.count >= self.indexthreshold:
+            nearestt, nearest = self._nearest_hit_indexed(x, y, dx, dy, skip)
+        elif self.count:
+            t = self.intersect(x, y, dx, dy)
+            if 0 <= skip < self.count:
+                t[skip] = math.inf
+            index = int(np.argmin(t))
+            if t[index] < math.inf:
+                nearestt, nearest = float(t[index]), index
+        if self.arccount:
+            t = self.arc_intersect(x, y, dx, dy)
+            index = int(np.argmin(t))
+            if t[index] < nearestt:
+                nearestt, nearest = float(t[index]), self.count + index
+        return nearestt, nearest
+
+    def nearest_hits(self, x, y, dx, dy, skip):
+        ''' nearest_hit for arrays of rays, testing every ray against every surface at once. skip is an array of the
+        line index each ray ignores, or -1. Returns arrays of distances and surface indices, inf and -1 for misses'''
+        rows = np.arange(len(x))
+        nearestt = np.full(len(x), math.inf)
+        nearest = np.full(len(x), -1, dtype=np.intp)
+        x, y, dx, dy = x[:,None], y[:,None], dx[:,None], dy[:,None]
+        if self.count:
+            t = self.intersect(x, y, dx, dy)
+            skipping = (skip >= 0) & (skip < self.count)
+            t[rows[skipping], skip[skipping]] = math.inf
+            nearest = np.argmin(t, axis=1)
+            nearestt = t[rows, nearest]
+        if self.arccount:
+            t = self.arc_intersect(x, y, dx, dy)
+            arcs = np.argmin(t, axis=1)
+            arct = t[rows, arcs]
+            closer = arct < nearestt
+            nearestt = np.where(closer, arct, nearestt)
+            nearest = np.where(closer, self.count + arcs, nearest)
+        return nearestt, np.where(nearestt < math.inf, nearest, -1)
+
+    def _nearest_hit_indexed(self, x, y, dx, dy, skip):
+        ''' nearest_hit that walks the grid cells along the ray, stopping once a hit is found within the cells walked'''
+        nearestt = math.inf
+        nearestline = -1
+        # Lines from several cells are gathered before testing so each NumPy call has enough work
+        batch = []
+        for lines, exitt in self.grid.along_ray(x, y, dx, dy):
+            batch.extend(lines)
+            if len(batch) < self.batchsize:
+                continue
+            nearestt, nearestline = self._nearest_of(x, y, dx, dy, batch, skip, nearestt, nearestline)
+            batch = []
+            # Anything in later cells must be further away
+            if nearestt <= exitt:
+                return nearestt, nearestline
+        if batch:
+            nearestt, nearestline = self._nearest_of(x, y, dx, dy, batch, skip, nearestt, nearestline)
+        return nearestt, nearestline
+
+    def _nearest_of(self, x, y, dx, dy, lines, skip, nearestt, nearestline):
+        ''' Nearest hit out of line indices lines, if closer than the current nearest'''
+        lines = np.array(lines, dtype=np.intp)
+        t = self.intersect(x, y, dx, dy, lines)
+        t[lines == skip] = math.inf
+        index = int(np.argmin(t))
+        if t[index] < nearestt:
+            return float(t[index]), int(lines[index])
+        return nearestt, nearestline
+
+    def normal(self, index, x=None, y=None):
+        ''' Unit vector perpendicular to the surface at index, same as Line.normal and Arc.normal.
+        Arcs need the point (x,y) on them where the normal is wanted'''
+        if index >= self.count:
+            arc = index - self.count
+            radius = self.arcr[arc]
+            return float((x - self.arcx[arc]) / radius), float((y - self.arcy[arc]) / radius)
+        length = math.sqrt(self.r[index])
+        return float(-self.linedy[index] / length), float(self.linedx[index] / length)
+
+    def surface_normals(self, surfaces, x, y):
+        ''' normal for an array of surface indices, at the points in arrays x and y'''
+        isarc = surfaces >= self.count
+        lines = surfaces[~isarc]
+        arcs = surfaces[isarc] - self.count
+        nx = np.empty(len(surfaces))
+        ny = np.empty(len(surfaces))
+        length = np.sqrt(self.r[lines])
+        nx[~isarc] = -self.linedy[lines] / length
+        ny[~isarc] = self.linedx[lines] / length
+        nx[isarc] = (x[isarc] - self.arcx[arcs]) / self.arcr[arcs]
+        ny[isarc] = (y[isarc] - self.arcy[arcs]) / self.arcr[arcs]
+        return nx, ny
+
+    def surface_owners(self, surfaces):
+        ''' Whether each of an array of surface indices is a mirror, and the position of the object it belongs to'''
+        mirror = np.concatenate((self.mirror[:self.count], self.arcmirror))
+        owner = np.concatenate((self.owner[:self.count], self.arcowner))
+        return mirror[surfaces], owner[surfaces]
+
+    def refractive_indices(self, wavelengths, count):
+        ''' Refractive index of every object for count rays with the given wavelengths (or None to use each n),
+        as an array with a row for each object in order and a column for each ray. Mirrors have 0'''
+        indices = np.zeros((len(self.objects), count))
+        for slot, obj in enumerate(self.objects):
+            if obj.interaction == "refract":
+                indices[slot] = obj.index(wavelengths)
+        return indices
+
+    def media(self, x, y):
+        ''' Position of the block that each point in arrays x and y is in, or -1 for air. Where blocks overlap the one
+        added last is on top. Only blocks whose bounding box holds a point are checked for whether they contain it'''
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        left, top, right, bottom = self.boxes().T
+        points, slots = np.nonzero((left <= x[:,None]) & (x[:,None] <= right) & (top <= y[:,None]) & (y[:,None] <= bottom))
+        self.tests += len(points)
+        result = np.full(len(x), -1, dtype=np.intp)
+        # Later blocks are checked last so they overwrite earlier ones
+        for slot in np.unique(slots).tolist():
+            candidates = points[slots == slot]
+            inside = self.objects[slot].contains(x[candidates], y[candidates])
+            result[candidates[inside]] = slot
+        return result
+
+    def index_at(self, x, y):
+        ''' Refractive index of the medium at point (x,y), 1 in air. Same as media for a single point'''
+        left, top, right, bottom = self.boxes().T
+        candidates = np.nonzero((left <= x) & (x <= right) & (top <= y) & (y <= bottom))[0]
+        self.tests += len(candidates)
+        for slot in reversed(candidates.tolist()):
+            if self.objects[slot].contains(x, y):
+                return self.objects[slot].n
+        return 1
+
+    def boxes(self):
+        ''' Bounding boxes of the objects as an array with a row (left, top, right, bottom) for each, rebuilt when
+        the geometry has changed. Mirrors get an empty box so containment queries never find them'''
+        if self._boxversion != self.version:
+            self._boxes = np.array([self._box_of(obj) for obj in self.objects], dtype=float).reshape(-1, 4)
+            self._boxversion = self.version
+        return self._boxes
+
+    def _box_of(self, obj):
+        return obj.box if obj.interaction == "refract" else (math.inf, math.inf, -math.inf, -math.inf)
+
+    def index_beyond(self, x, y, dx, dy, nx, ny):
+        ''' Refractive index on the far side of a surface with unit normal (nx,ny) at (x,y), for a beam in direction (dx,dy)'''
+        return self.index_at(*past_surface(x, y, dx, dy, nx, ny))
+
+    def is_mirror(self, index):
+        ''' Whether the surface at index belongs to a mirror. Refractive indices of blocks are found by index_beyond'''
+        if index >= self.count:
+            return bool(self.arcmirror[index - self.count])
+        return bool(self.mirror[index])
+
+class LineGrid:
+
+    ''' Uniform grid spatial index of lines. Each square cell of size cellsize lists the indices of lines
+    whose bounding box overlaps it, so only lines near a point or ray need checking'''
+
+    def __init__(self, cellsize=40):
+        self.cellsize = cellsize
+        self.clear()
+
+    def clear(self):
+        # Line indices in each cell, and the cells each line is in so it can be removed
+        self.cells = {}
+        self.linecells = {}
+        # Range of cells that have ever held lines, rays leaving this range can't hit anything
+        self.mini = self.minj = math.inf
+        self.maxi = self.maxj = -math.inf
+
+    def insert(self, index, x1, y1, x2, y2):
+        ''' Add line index with the given end points, replacing it if already present'''
+        if index in self.linecells:
+            self.remove(index)
+        i1, i2 = int(min(x1, x2) // self.cellsize), int(max(x1, x2) // self.cellsize)
+        j1, j2 = int(min(y1, y2) // self.cellsize), int(max(y1, y2) // self.cellsize)
+        self.mini, self.maxi = min(self.mini, i1), max(self.maxi, i2)
+        self.minj, self.maxj = min(self.minj, j1), max(self.maxj, j2)
+        keys = []
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                self.cells.setdefault((i, j), set()).add(index)
+                keys.append((i, j))
+        self.linecells[index] = keys
+
+    def copy(self):
+        ''' Separate grid of the same lines'''
+        grid = copy.copy(self)
+        grid.cells = {key: set(cell) for key, cell in self.cells.items()}
+        grid.linecells = dict(self.linecells)
+        return grid
+
+    def remove(self, index):
+        for key in self.linecells.pop(index, ()):
+            cell = self.cells[key]
+            cell.discard(index)
+            if not cell:
+                del self.cells[key]
+
+    def near_point(self, x, y, radius):
+        ''' Indices of lines in the cells within radius of point (x,y)'''
+        i1, i2 = int((x - radius) // self.cellsize), int((x + radius) // self.cellsize)
+        j1, j2 = int((y - radius) // self.cellsize), int((y + radius) // self.cellsize)
+        if i1 == i2 and j1 == j2:
+            return list(self.cells.get((i1, j1), ()))
+        lines = set()
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                lines.update(self.cells.get((i, j), ()))
+        return list(lines)
+
+    def along_ray(self, x, y, dx, dy):
+        ''' Walk the cells the ray from (x,y) in direction (dx,dy) passes through in order.
+        Yields the set of line indices in each cell and the distance along the ray where it leaves the cell'''
+        size = self.cellsize
+        i = int(x // size)
+        j = int(y // size)
+        # Direction to step through cells, distance to the next cell boundary and distance between boundaries
+        stepi = 1 if dx > 0 else -1
+        stepj = 1 if dy > 0 else -1
+        nexti = ((i + (dx > 0)) * size - x) / dx if dx != 0 else math.inf
+        nextj = ((j + (dy > 0)) * size - y) / dy if dy != 0 else math.inf
+        deltai = size / abs(dx) if dx != 0 else math.inf
+        deltaj = size / abs(dy) if dy != 0 else math.inf
+
+        while True:
+            # Stop once heading away from every cell that has lines
+            if (stepi < 0 and i < self.mini) or (stepi > 0 and i > self.maxi):
+                return
+            if (stepj < 0 and j < self.minj) or (stepj > 0 and j > self.maxj):
+                return
+            exitt = min(nexti, nextj)
+            yield self.cells.get((i, j), ()), exitt
+            if nexti < nextj:
+                i += stepi
+                nexti += deltai
+            else:
+                j += stepj
+                nextj += deltaj
+
+def line_count(obj):
+    ''' Number of straight lines making up a mirror or block'''
+    if isinstance(obj, Mirror):
+        return 1
+    if obj.curved:
+        return sum(isinstance(surface, Line) for surface in obj.surfaces)
+    return len(obj.points)
+
+def object_box(obj, margin=1):
+    ''' Bounding box (left, top, right, bottom) of a mirror or block, expanded by margin on each side'''
+    if isinstance(obj, Mirror):
+        x1, y1, x2, y2 = object_lines(obj)
+        return (min(x1.min(), x2.min()) - margin, min(y1.min(), y2.min()) - margin,
+                max(x1.max(), x2.max()) + margin, max(y1.max(), y2.max()) + margin)
+    # Points of a curved block lie on the curve so they cover it, within the margin
+    points = np.asarray(obj.points, dtype=float)
+    return (points[:,0].min() - margin, points[:,1].min() - margin, points[:,0].max() + margin, points[:,1].max() + margin)
+
+def object_lines(obj):
+    ''' Start and end coordinates of the straight lines making up a mirror or block as arrays x1, y1, x2, y2'''
+    if isinstance(obj, Mirror):
+        return np.array([obj.x1]), np.array([obj.y1]), np.array([obj.x2]), np.array([obj.y2])
+    if obj.curved:
+        lines = [surface for surface in obj.surfaces if isinstance(surface, Line)]
+        return (np.array([line.x1 for line in lines], dtype=float), np.array([line.y1 for line in lines], dtype=float),
+                np.array([line.x2 for line in lines], dtype=float), np.array([line.y2 for line in lines], dtype=float))
+    points = np.asarray(obj.points, dtype=float)
+    # Each corner joins to the next, with the last joining back to the first
+    following = np.roll(points, -1, axis=0)
+    return points[:,0], points[:,1], following[:,0], following[:,1]
+
+def object_arcs(obj):
+    ''' Arcs making up the curved surfaces of a mirror or block'''
+    if obj.curved:
+        return [surface for surface in obj.surfaces if isinstance(surface, Arc)]
+    return []
+
+## Background tracing
+class TraceJob:
+
+    ''' Lasers to trace against a snapshot of a scene's geometry, so the scene can carry on changing meanwhile. source
+    is the geometry the snapshot was taken from and keys has the beamkey of each laser for it. fresnel turns on
+    partial reflection for every laser as well as those that have it set'''
+
+    def __init__(self, engine, bounds, source, lasers, fresnel=False):
+        self.engine = engine
+        self.bounds = tuple(bounds)
+        self.fresnel = fresnel
+        self.source = source
+        self.geometry = source.snapshot()
+        self.mirrors = [obj for obj in self.geometry.objects if obj.interaction == "reflect"]
+        self.blocks = [obj for obj in self.geometry.objects if obj.interaction == "refract"]
+        # The lasers in the scene, and copies of them as they were, which are what is traced
+        self.lasers = lasers
+        self.copies = [copy.copy(laser) for laser in lasers]
+        self.keys = {laser: laser.beamkey(engine, bounds, source, fresnel) for laser in lasers}
+        self.cancelled = False
+
+    def passes(self):
+        ''' Whether to trace quick previews of the lasers before tracing them fully. Not needed when the preview
+        would be traced the same way'''
+        if self.engine != "ray" or self.fresnel or any(laser.spectrum is not None or laser.fresnel
+                                                       for laser in self.copies):
+            return (False, True)
+        return (True,)
+
+class TraceWorker:
+
+    ''' Traces laser paths on a background thread so the simulator keeps responding while a heavy scene is traced.
+    Each TraceJob is traced in two passes, quick previews of every laser to show while the scene is changing and then
+    full traces. Submitting a job cancels any earlier one, which stops after the laser it is tracing. Finished paths
+    are collected by the main thread as (job, laser, path, whether it is the full trace)'''
+
+    def __init__(self, notify=None):
+        self.condition = threading.Condition()
+        # Job waiting to start and the one being traced
+        self.waiting = None
+        self.current = None
+        self.results = deque()
+        self.thread = None
+        self.stopped = False
+        # Called from the worker thread when there are paths to collect, once until they are collected
+        self.notify = notify
+        self.notified = False
+
+    @property
+    def idle(self):
+        ''' Nothing is being traced or waiting to be, though there may be paths still to collect'''
+        return self.waiting is None and self.current is None
+
+    def submit(self, job):
+        with self.condition:
+            for old in (self.waiting, self.current):
+                if old is not None:
+                    old.cancelled = True
+            self.waiting = job
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="TraceWorker", daemon=True)
+            self.thread.start()
+
+    @property
+    def ready(self):
+        ''' There are paths waiting to be collected'''
+        return bool(self.results)
+
+    def collect(self):
+        ''' Paths finished since last collected. An error raised while tracing is raised again here'''
+        with self.condition:
+            results = list(self.results)
+            self.results.clear()
+            self.notified = False
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def finished(self, result):
+        ''' Add a path or error to be collected, notifying if nothing else is waiting to be'''
+        with self.condition:
+            self.results.append(result)
+            notify = not self.notified
+            self.notified = True
+        if notify and self.notify is not None:
+            self.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            if self.waiting is not None:
+                self.waiting.cancelled = True
+            if self.current is not None:
+                self.current.cancelled = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.waiting is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                self.current, self.waiting = self.waiting, None
+            try:
+                self.trace(self.current)
+            except Exception as error:
+                self.finished(error)
+            finally:
+                with self.condition:
+                    self.current = None
+
+    def trace(self, job):
+        for full in job.passes():
+            for laser, snapshot in zip(job.lasers, job.copies):
+                if job.cancelled:
+                    return
+                if full:
+                    path = snapshot.trace(job.engine, job.bounds, job.mirrors, job.blocks, job.geometry, job.fresnel)
+                else:
+                    path = snapshot.preview().trace("ray", job.bounds, job.mirrors, job.blocks, job.geometry)
+                self.finished((job, laser, path, full))
 
 class SimulatorScene(BaseScene):
 
-    '''Where the user can experiment with the simulation'''
+    '''Where the user can experiment with the simulation. Lasers are traced in the background by worker, a TraceWorker,
+    or while rendering if it is None'''
 
-    def __init__(self):
+    # States where the object being added follows the mouse
+    LIVE_STATES = ("Laser Direction", "Mirror Point 2", "Semicircle Orientation")
+
+    def __init__(self, worker=None):
         BaseScene.__init__(self)
         self.title = "Simulator"
+        self.worker = worker
+        # Number of times each laser's path has been updated from the worker, those left out longest are traced first
+        self.updates = {}
 
         # Lists of current objects
         self.lasers = []
         self.mirrors = []
         self.blocks = []
+        # Detectors measuring where the beams go, which can only be added by loading a scene
+        self.detectors = []
+        # Lines of all mirrors and blocks packed for vectorised collision tests
+        self.geometry = SceneGeometry()
 
         # Buttons to add objects
         self.laserbut = Button(0,0,"Laser","smallFont",BLACK,WHITE,BLACK)
@@ -430,13 +2618,141 @@ class SimulatorScene(BaseScene):
         # Button to reset the screen
         self.resetbut = Button(0,0,"Reset","mediumFont",DARKBLUE,WHITE,BLACK)
 
+        # Buttons to save the scene to a file and load it back
+        self.savebut = Button(0,0,"Save","smallFont",BLACK,WHITE,BLACK)
+        self.loadbut = Button(0,0,"Load","smallFont",BLACK,WHITE,BLACK)
+        self.filename = "scene.json"
+
+        # Size of the screen when last drawn, used when saving
+        self.size = (700,600)
+
+        # Tracing engine used to draw laser paths, "particle" marches a particle and "ray" jumps between intersections
+        self.engine = "particle"
+        self.enginebut = Button(0,0,"Engine: Particle","smallFont",BLACK,WHITE,BLACK)
+
+        # Whether lasers partially reflect off blocks, splitting into a tree of fainter beams
+        self.fresnel = False
+        self.fresnelbut = Button(0,0,"Reflections: Off","smallFont",BLACK,WHITE,BLACK)
+
         # The "neutral" state where no objects are being added, state tells the user what they should be selecting
         self.state = "an object"
+        self.instructions = Label("", "smallFont", BLACK)
+        # Mouse position when live objects were last changed, they don't need changing again until it moves
+        self.lastmouse = None
+
+        # Layers kept between frames so only what changes is drawn again. The background has the banner and buttons,
+        # and the scenery has the blocks and mirrors drawn over the background. Lasers, beams and detectors go on top
+        self.background = None
+        self.scenery = None
+        # Surface each changed area is drawn on before being copied to a layer or the screen. Lines are drawn whole
+        # rather than clipped to the area, as pygame draws clipped lines slightly differently
+        self.canvas = None
+        # Text and area of each item on the background when it was drawn
+        self.toolbar = []
+        # Areas where the scenery needs drawing again, None for all of it
+        self.changes = None
+        # What was drawn for each laser, its pointer position and area, and its path and the area that covers
+        self.drawn = {}
+
+    def Policy(self):
+        # Only needs running every frame while an object follows the mouse, or to draw the whole screen. Anything else
+        # changes on input, or when the worker has paths ready which it notifies with an event
+        if self.invalid is None or self.state.startswith(self.LIVE_STATES):
+            return "live"
+        if self.worker is not None and self.worker.notify is None and not (self.worker.idle and not self.worker.ready):
+            return "live"
+        return "idle"
+
+    def ObjectList(self, obj):
+        ''' List of the scene that holds objects of the same type as obj'''
+        if isinstance(obj, Laser):
+            return self.lasers
+        elif obj.interaction == "detect":
+            return self.detectors
+        elif obj.interaction == "reflect":
+            return self.mirrors
+        return self.blocks
+
+    def AddObject(self, obj):
+        ''' Add a laser, mirror, block or detector to the scene'''
+        self.ObjectList(obj).append(obj)
+        if not isinstance(obj, (Laser, Detector)):
+            version = self.geometry.version
+            self.geometry.add(obj)
+            self.KeepPaths(version, object_box(obj))
+            self.Changed(object_box(obj))
+
+    def ReplaceLast(self, obj):
+        ''' Replace the most recently added object of the same type with obj, used when it is being edited live'''
+        objects = self.ObjectList(obj)
+        if not isinstance(obj, (Laser, Detector)):
+            version = self.geometry.version
+            oldbox = object_box(objects[-1])
+            self.geometry.replace(objects[-1], obj)
+            newbox = object_box(obj)
+            # Area covering where the object was and where it is now
+            self.KeepPaths(version, (min(oldbox[0], newbox[0]), min(oldbox[1], newbox[1]),
+                                     max(oldbox[2], newbox[2]), max(oldbox[3], newbox[3])))
+            self.Changed(oldbox)
+            self.Changed(newbox)
+        objects[-1] = obj
+
+    @contextmanager
+    def Editing(self, obj):
+        ''' Context for changing obj in place. Afterwards the geometry is updated and only lasers whose paths went near
+        where the object was or is now are retraced, or just the laser itself if obj is one'''
+        if isinstance(obj, Laser):
+            yield
+            obj.pathkey = None
+            obj.queued = None
+            return
+        version = self.geometry.version
+        oldbox = object_box(obj)
+        yield
+        self.geometry.update(obj)
+        newbox = object_box(obj)
+        self.KeepPaths(version, (min(oldbox[0], newbox[0]), min(oldbox[1], newbox[1]),
+                                 max(oldbox[2], newbox[2]), max(oldbox[3], newbox[3])))
+        self.Changed(oldbox)
+        self.Changed(newbox)
+
+    def LoadScene(self, scene):
+        ''' Replace all objects with those of an OpticalScene'''
+        self.lasers = []
+        self.mirrors = []
+        self.blocks = []
+        self.detectors = []
+        self.geometry = SceneGeometry()
+        self.updates = {}
+        for obj in scene.lasers + scene.mirrors + scene.blocks + scene.detectors:
+            self.AddObject(obj)
+        self.fresnel = False
+        self.fresnelbut.text = "Reflections: " + ("On" if self.fresnel else "Off")
+        # Everything placed has changed
+        self.changes = None
+
+    def Changed(self, box):
+        ''' Mark the area box (left, top, right, bottom) where objects have been added or changed, so the scenery is
+        drawn again there'''
+        if self.changes is not None:
+            # Wide enough for the thickest mirror line
+            self.changes.append(box_rect(box, 4))
+
+    def KeepPaths(self, version, box):
+        ''' After the geometry changes from version, mark cached laser paths that don't go near box as
+        still up to date so only lasers affected by the change are retraced'''
+        for laser in self.lasers:
+            if laser.pathkey is not None and laser.pathkey[2] == version and not laser.path.touches(box):
+                laser.pathkey = laser.pathkey[:2] + (self.geometry.version,) + laser.pathkey[3:]
 
     def ProcessInput(self, events):
         for event in events:
             # Buttons check if they have been clicked
             self.resetbut.handle_event(event)
+            self.savebut.handle_event(event)
+            self.loadbut.handle_event(event)
+            self.enginebut.handle_event(event)
+            self.fresnelbut.handle_event(event)
             self.laserbut.handle_event(event)
             self.mirrorbut.handle_event(event)
             self.blockbut.handle_event(event)
@@ -447,23 +2763,25 @@ class SimulatorScene(BaseScene):
                 # and it is waiting for a button to be pressed
 
                 mouse = pygame.mouse.get_pos()
+                # Any new live object is updated straight away even if the mouse doesn't move
+                self.lastmouse = None
 
                 # First click for laser sets centre position
                 if self.state == "Laser Centre":
-                        self.lasers.append(Laser(mouse,decayincr=1))
+                        self.AddObject(Laser(mouse,decayincr=1))
                         self.state = "Laser Direction"
 
                 # Second click for laser sets where to point towards
                 elif "Laser Direction" in self.state:
                     # Set final laser to a long time to decay (small decay increment)
-                    self.lasers[-1] = Laser(self.lasers[-1].center, rot=self.lasers[-1].rotdeg, decayincr = 0.01)
+                    self.ReplaceLast(Laser(self.lasers[-1].center, rot=self.lasers[-1].rotdeg, decayincr = 0.01))
                     # Laser position is final go back to neutral state
                     self.state = "an object"
 
                 # First click for mirror create Mirror object at the point they clicked
                 elif self.state == "Mirror Point 1":
                     # mouse x and y are incremented by one so that the length of the mirror is non-zero
-                    self.mirrors.append(Mirror(mouse,(mouse[0]+1,mouse[1]+1)))
+                    self.AddObject(Mirror(mouse,(mouse[0]+1,mouse[1]+1)))
                     self.state = "Mirror Point 2"
 
                 # Second click for mirror sets final position
@@ -487,7 +2805,7 @@ class SimulatorScene(BaseScene):
                 elif self.state == "Block Point 3":
                     if mouse not in self.currblock:
                         self.currblock.append(mouse)
-                        self.blocks.append(Block(self.currblock,1.52))
+                        self.AddObject(Block(list(self.currblock),BLOCK_N))
                         self.state = "More Block Points, Right-click to stop"
 
                 # Any more than the third click, either allows more points to
@@ -498,11 +2816,11 @@ class SimulatorScene(BaseScene):
                     else:
                         if mouse not in self.currblock:
                             self.currblock.append(mouse)
-                            self.blocks[-1] = Block(self.currblock,1.52)
+                            self.ReplaceLast(Block(list(self.currblock),BLOCK_N))
 
                 # First click for semicircle defines centre
                 elif self.state == "Semicircle Centre":
-                    self.blocks.append(SemiCircleBlock(mouse, 1, 0, 1.52))
+                    self.AddObject(SemiCircleBlock(mouse, 1, 0, BLOCK_N))
                     self.state = "Semicircle Orientation"
 
                 # Second click for semicircle defines orientation
@@ -513,7 +2831,29 @@ class SimulatorScene(BaseScene):
     def Update(self):
         # Reset simulator by starting new scene if button pressed
         if self.resetbut.pressed == True:
-            self.SwitchToScene(SimulatorScene)
+            self.SwitchToScene(functools.partial(SimulatorScene, self.worker))
+
+        # Save or load the placed objects, only when not part way through adding one
+        if self.savebut.pressed == True:
+            if self.state == "an object":
+                save_scene(self, self.filename)
+            self.savebut.pressed = False
+
+        if self.loadbut.pressed == True:
+            if self.state == "an object" and os.path.exists(self.filename):
+                self.LoadScene(load_scene(self.filename))
+            self.loadbut.pressed = False
+
+        # Switch between tracing engines so they can be compared
+        if self.enginebut.pressed == True:
+            self.engine = ENGINES[(ENGINES.index(self.engine) + 1) % len(ENGINES)]
+            self.enginebut.text = "Engine: " + self.engine.capitalize()
+            self.enginebut.pressed = False
+
+        if self.fresnelbut.pressed == True:
+            self.fresnel = not self.fresnel
+            self.fresnelbut.text = "Reflections: " + ("On" if self.fresnel else "Off")
+            self.fresnelbut.pressed = False
 
         # Buttons to start procedure to add each object
         if self.laserbut.pressed == True:
@@ -532,12 +2872,16 @@ class SimulatorScene(BaseScene):
             self.state = "Semicircle Centre"
             self.semicirclebut.pressed = False
 
-        # "Live" responding object creation code is here
+        # "Live" responding object creation code is here. Objects are changed in place, and only when the mouse moves
+        mouse = pygame.mouse.get_pos()
+        if mouse == self.lastmouse:
+            return
+        self.lastmouse = mouse
 
         # Second click for laser sets where to point towards
         if "Laser Direction" in self.state:
-            cen = self.lasers[-1].center
-            mouse = pygame.mouse.get_pos()
+            laser = self.lasers[-1]
+            cen = laser.center
 
             # Set angle to point towards mouse
             dx = mouse[0] - cen[0]
@@ -548,23 +2892,25 @@ class SimulatorScene(BaseScene):
             # Show angle on screen
             self.state = "Laser Direction " + str(round(360-angle,1)) + "°"
 
-            # Replace last laser to now point in new direction
-            self.lasers[-1] = Laser(self.lasers[-1].center, rot=angle, decayincr=1)
+            # Turn last laser to now point in new direction
+            with self.Editing(laser):
+                laser.set_rotation(angle)
 
         # Second click for mirror is "live"
         elif self.state == "Mirror Point 2":
-            point1 = self.mirrors[-1].pos1
-            mouse = pygame.mouse.get_pos()
+            mirror = self.mirrors[-1]
+            point1 = mirror.pos1
             if mouse == point1:
                 mouse = (mouse[0]+1,mouse[1]+1)
-            # Replace last mirror to join to the position of the mouse
-            self.mirrors[-1] = Mirror(point1,mouse)
+            # Move the end of last mirror to the position of the mouse
+            with self.Editing(mirror):
+                mirror.set_ends(point1, mouse)
 
         # Second semicircle click is "live" orientation
         elif "Semicircle Orientation" in self.state:
             # Code is similar to laser direction as also setting direction
-            cen = self.blocks[-1].center
-            mouse = pygame.mouse.get_pos()
+            block = self.blocks[-1]
+            cen = block.center
 
             dx = mouse[0] - cen[0]
             dy = mouse[1] - cen[1]
@@ -579,34 +2925,777 @@ class SimulatorScene(BaseScene):
             # Show angle on screen
             self.state = "Semicircle Orientation " + str(round(math.degrees(angle),1)) + "°"
 
-            # Replace last laser to now point in new direction
-            self.blocks[-1] = SemiCircleBlock(cen, radius, angle, 1.52)
+            # Resize and turn last semicircle to follow the mouse
+            with self.Editing(block):
+                block.reshape(cen, radius, angle)
 
     def Render(self, screen, assets):
-        self.DrawBanner(screen, assets)
+        size = screen.get_size()
+        if self.background is None or self.background.get_size() != size:
+            # New or resized window, every layer is drawn again
+            self.background = pygame.Surface(size)
+            self.scenery = pygame.Surface(size)
+            self.canvas = pygame.Surface(size)
+            self.toolbar = []
+            self.changes = None
+            self.Invalidate()
+        self.size = size
+        self.DrawToolbar(assets)
+        self.DrawScenery()
+
+        # Lasers are only retraced if the scene has changed near them
+        self.traced = []
+        if self.worker is not None:
+            self.TraceInBackground()
+        drawn = {}
+        for laser in self.lasers:
+            old = self.drawn.get(laser)
+            pointer = (laser.center, laser.rotdeg, type(laser))
+            pointerrect = old[1] if old is not None and old[0] == pointer else laser.rect.inflate(2, 2)
+            path = pathrect = None
+            if laser.on and self.worker is None:
+                oldpath = laser.path
+                path = laser.beam(self.engine, size, self.mirrors, self.blocks, self.geometry, self.fresnel)
+                if path is not oldpath:
+                    self.traced.append(path)
+            elif laser.on:
+                # Not traced at all yet if there is no path
+                path = laser.path
+            if path is not None and old is not None and old[2] is path:
+                pathrect = old[3]
+            elif path is not None:
+                # A light source giving out no rays has nothing to draw
+                box = path.box()
+                pathrect = box_rect(box, 2) if box is not None else None
+            drawn[laser] = (pointer, pointerrect, path, pathrect)
+
+        # Lasers and beams that have changed are drawn again where they were and where they are now
+        for laser in self.drawn.keys() | drawn.keys():
+            old, new = self.drawn.get(laser), drawn.get(laser)
+            if old != new:
+                for state in (old, new):
+                    if state is not None:
+                        self.Invalidate([rect for rect in (state[1], state[3]) if rect is not None])
+        self.drawn = drawn
+
+        # Detectors only need to measure again when a beam has changed
+        if self.traced:
+            measure(self.detectors, [laser.path for laser in self.lasers if laser.on and laser.path is not None])
+            self.Invalidate([detector.rect for detector in self.detectors])
+
+        if self.invalid is None:
+            self.dirty = None
+            rects = [screen.get_rect()]
+        else:
+            rects = [rect.clip(screen.get_rect()) for rect in merge_rects(self.invalid)]
+            rects = self.dirty = [rect for rect in rects if rect.w and rect.h]
+        for rect in rects:
+            self.Compose(screen, rect)
+        self.invalid = []
+
+    def TraceInBackground(self):
+        ''' Take the paths the worker has finished, and send it the lasers whose paths are out of date if any of them
+        haven't been sent as they are now. Paths from jobs that have since been replaced are still shown, as they are
+        closer than the path before, but only a full trace from the latest job a laser was sent in is kept as up to date'''
+        lasers = set(self.lasers)
+        for job, laser, path, full in self.worker.collect():
+            if job.source is not self.geometry or laser not in lasers:
+                continue
+            if laser.pathkey == laser.beamkey(self.engine, self.size, self.geometry, self.fresnel):
+                continue
+            laser.path = path
+            if full and laser.queued is job:
+                laser.pathkey = job.keys[laser]
+            self.updates[laser] = self.updates.get(laser, 0) + 1
+            self.traced.append(path)
+
+        outdated = [laser for laser in self.lasers
+                    if laser.on and laser.pathkey != laser.beamkey(self.engine, self.size, self.geometry, self.fresnel)]
+        if any(laser.queued is None or laser.queued.keys[laser] != laser.beamkey(self.engine, self.size, self.geometry, self.fresnel)
+               for laser in outdated):
+            # The new job replaces any unfinished one, so has every laser that is out of date
+            outdated.sort(key=lambda laser: self.updates.get(laser, 0))
+            job = TraceJob(self.engine, self.size, self.geometry, outdated, self.fresnel)
+            for laser in outdated:
+                laser.queued = job
+            self.worker.submit(job)
+
+    def DrawToolbar(self, assets):
+        ''' Draw the banner, buttons and instructions on the background again if the text of any of them has changed,
+        and mark the areas of those that changed for drawing again'''
+        width, height = self.size
+        items = [(self.laserbut, "bottomleft", (5, height-5)),
+                 (self.mirrorbut, "bottomleft", (70, height-5)),
+                 (self.blockbut, "bottomleft", (135, height-5)),
+                 (self.semicirclebut, "bottomleft", (195, height-5)),
+                 (self.resetbut, "topleft", (5,3)),
+                 (self.savebut, "topleft", (80,8)),
+                 (self.loadbut, "topleft", (130,8)),
+                 (self.enginebut, "topright", (width-5,8)),
+                 (self.fresnelbut, "bottomright", (width-5, height-5))]
+        self.instructions.text = "Click to select " + self.state
+        if [text for text, rect in self.toolbar] == [button.text for button, alignment, coords in items] + [self.instructions.text]:
+            return
 
-        # Buttons
-        self.laserbut.draw(screen, "bottomleft", (5, screen.get_height()-5), assets)
-        self.mirrorbut.draw(screen, "bottomleft", (70, screen.get_height()-5), assets)
-        self.blockbut.draw(screen, "bottomleft", (135, screen.get_height()-5), assets)
-        self.semicirclebut.draw(screen, "bottomleft", (195, screen.get_height()-5), assets)
-        self.resetbut.draw(screen, "topleft", (5,3), assets)
+        self.DrawBanner(self.background, assets)
+        toolbar = []
+        for button, alignment, coords in items:
+            button.draw(self.background, alignment, coords, assets)
+            toolbar.append((button.text, button.bordrect.copy()))
 
         # Instructions
-        instText = assets['smallFont'].render("Click to select "+self.state,True,BLACK)
-        instTextRect = instText.get_rect(bottomleft = (375, screen.get_height()-5))
-        screen.blit(instText,instTextRect)
-
-        # Objects
-        for block in self.blocks:
-            block.draw(screen)
-        for mirror in self.mirrors:
-            mirror.draw(screen)
+        instTextRect = self.instructions.draw(self.background, "bottomleft", (375, height-5), assets)
+        toolbar.append((self.instructions.text, instTextRect))
+
+        if self.toolbar and self.changes is not None:
+            for old, new in zip(self.toolbar, toolbar):
+                if old != new:
+                    self.changes.extend((old[1], new[1]))
+        else:
+            self.changes = None
+        self.toolbar = toolbar
+
+    def DrawScenery(self):
+        ''' Draw the background and the blocks and mirrors over it onto the scenery again where it has changed, and
+        mark those areas of the screen for drawing again'''
+        if self.changes is None:
+            rects = [self.scenery.get_rect()]
+            self.Invalidate()
+        else:
+            rects = merge_rects(self.changes)
+            self.Invalidate(rects)
+        for rect in rects:
+            self.canvas.blit(self.background, rect, rect)
+            for block in self.blocks:
+                if rect.colliderect(box_rect(block.box)):
+                    block.draw(self.canvas)
+            for mirror in self.mirrors:
+                if rect.colliderect(box_rect(object_box(mirror), 3)):
+                    mirror.draw(self.canvas)
+            self.scenery.blit(self.canvas, rect, rect)
+        self.changes = []
+
+    def Compose(self, screen, rect):
+        ''' Draw the area rect of the screen from the scenery with the lasers, beams and detectors over it'''
+        self.canvas.blit(self.scenery, rect, rect)
+        # Beams are drawn 3 pixels wide so can reach just outside the lines of their path
+        box = (rect.left - 2, rect.top - 2, rect.right + 2, rect.bottom + 2)
         for laser in self.lasers:
-            laser.draw(screen)
-            laser.emit_particle(screen,self.mirrors,self.blocks)
-
-def main(width, height, fps):
+            pointer, pointerrect, path, pathrect = self.drawn[laser]
+            if rect.colliderect(pointerrect):
+                laser.draw(self.canvas)
+            if pathrect is not None and rect.colliderect(pathrect) and path.touches(box):
+                draw_path(self.canvas, path)
+        for detector in self.detectors:
+            if rect.colliderect(detector.rect):
+                detector.draw(self.canvas)
+        screen.blit(self.canvas, rect, rect)
+
+## Headless tracing
+class OpticalScene:
+
+    ''' Lasers, mirrors, blocks and detectors of a scene without any display, so they can be traced headless'''
+
+    def __init__(self, size=(700,600)):
+        # Size of the area the beams are traced in, beams stop at its edges like at the edge of the screen
+        self.size = tuple(size)
+        self.lasers = []
+        self.mirrors = []
+        self.blocks = []
+        self.detectors = []
+        self.geometry = SceneGeometry()
+
+    def add(self, obj):
+        ''' Add a laser, mirror, block or detector to the scene'''
+        if isinstance(obj, Laser):
+            self.lasers.append(obj)
+        elif obj.interaction == "detect":
+            # Beams pass through detectors so they aren't part of the geometry
+            self.detectors.append(obj)
+        elif obj.interaction == "reflect":
+            self.mirrors.append(obj)
+            self.geometry.add(obj)
+        else:
+            self.blocks.append(obj)
+            self.geometry.add(obj)
+
+def trace(scene, engine="ray", bounds=None):
+    ''' Trace every laser of scene without drawing anything. Works with an OpticalScene or SimulatorScene.
+    The detectors of the scene are reset and measure the traced paths.
+    Returns a list of BeamPath, one for each laser'''
+    if bounds is None:
+        bounds = scene.size
+    paths = [laser.beam(engine, bounds, scene.mirrors, scene.blocks, scene.geometry) for laser in scene.lasers]
+    measure(scene.detectors, paths)
+    return paths
+
+def measure(detectors, paths):
+    ''' Reset detectors and add the crossings of every one of paths'''
+    for detector in detectors:
+        detector.reset()
+        for path in paths:
+            detector.record_path(path)
+
+def detect(scene, x, y, dx, dy, wavelengths=None, maxlength=math.inf, chunksize=DETECT_CHUNK, **options):
+    ''' Trace rays starting at arrays x, y with unit directions dx, dy through scene with trace_batch, adding where
+    they cross to the scene's detectors without keeping their paths. Rays are traced chunksize at a time so millions
+    can be traced without running out of memory. Other options such as fresnel are passed on to trace_batch.
+    Detectors are not reset first so several sets of rays can be added up. Returns the scene's detectors'''
+    x, y, dx, dy = (np.asarray(values, dtype=float) for values in (x, y, dx, dy))
+    if wavelengths is not None:
+        wavelengths = np.broadcast_to(np.asarray(wavelengths, dtype=float), x.shape)
+    for start in range(0, len(x), chunksize):
+        chunk = slice(start, start + chunksize)
+        trace_batch(scene.size, scene.geometry, x[chunk], y[chunk], dx[chunk], dy[chunk],
+                    None if wavelengths is None else wavelengths[chunk], maxlength, detectors=scene.detectors,
+                    keep=False, **options)
+    return scene.detectors
+
+def scene_from_dict(data):
+    ''' Build an OpticalScene from a description such as
+    {"size": [700,600], "lasers": [{"center": [100,300], "rot": 270, "spectrum": [450, 550, 650]}],
+     "sources": [{"type": "collimated", "center": [100,500], "rot": 270, "width": 40, "count": 20},
+                 {"type": "fan", "center": [100,100], "rot": 270, "spread": 30, "count": 20},
+                 {"type": "point", "center": [350,550], "count": 36}],
+     "mirrors": [{"pos1": [400,200], "pos2": [450,400]}],
+     "blocks": [{"points": [[200,250],[300,250],[300,350]], "n": 1.52, "dispersion": {"model": "cauchy", "coefficients": [1.5, 0.004]}}],
+     "semicircles": [{"center": [550,300], "radius": 80, "rotation": 0.3, "n": 1.52}],
+     "lenses": [{"center": [300,100], "radius": 120, "thickness": 20, "n": 1.52, "rotation": 1.57}],
+     "curvedmirrors": [{"pos1": [600,450], "pos2": [650,550], "radius": 150}],
+     "detectors": [{"pos1": [680,100], "pos2": [680,500], "bins": 100}]}
+    Sources can have all the settings of a laser as well. Blocks, semicircles and lenses can all have a dispersion model'''
+    scene = OpticalScene(data.get('size', (700,600)))
+    for laser in data.get('lasers', []):
+        scene.add(Laser(tuple(laser['center']), rot=laser.get('rot', 0), decayincr=laser.get('decayincr', 0.01),
+                        on=laser.get('on', True), spectrum=laser.get('spectrum'), fresnel=laser.get('fresnel', False)))
+    for source in data.get('sources', []):
+        # Only collimated beams have a width and fans a spread
+        shape = {name: source[name] for name in ('width', 'spread', 'count') if name in source}
+        scene.add(SOURCE_TYPES[source['type']](tuple(source['center']), rot=source.get('rot', 0),
+                                               decayincr=source.get('decayincr', 0.01), on=source.get('on', True),
+                                               spectrum=source.get('spectrum'), fresnel=source.get('fresnel', False), **shape))
+    for mirror in data.get('mirrors', []):
+        scene.add(Mirror(tuple(mirror['pos1']), tuple(mirror['pos2'])))
+    for block in data.get('blocks', []):
+        scene.add(Block([tuple(point) for point in block['points']], block.get('n', BLOCK_N), dispersion_from_dict(block)))
+    for semicircle in data.get('semicircles', []):
+        scene.add(SemiCircleBlock(tuple(semicircle['center']), semicircle['radius'], semicircle.get('rotation', 0),
+                                  semicircle.get('n', BLOCK_N), dispersion_from_dict(semicircle)))
+    for lens in data.get('lenses', []):
+        scene.add(Lens(tuple(lens['center']), lens['radius'], lens['thickness'], lens.get('n', BLOCK_N), lens.get('rotation', 0),
+                       lens.get('aperture'), dispersion_from_dict(lens)))
+    for mirror in data.get('curvedmirrors', []):
+        scene.add(CurvedMirror(tuple(mirror['pos1']), tuple(mirror['pos2']), mirror['radius']))
+    for detector in data.get('detectors', []):
+        scene.add(Detector(tuple(detector['pos1']), tuple(detector['pos2']), detector.get('bins', 100)))
+    return scene
+
+def dispersion_from_dict(data):
+    ''' Dispersion model from the "dispersion" entry of a block description, or None if it has none'''
+    if data.get('dispersion') is None:
+        return None
+    return DISPERSION_MODELS[data['dispersion']['model']](*data['dispersion']['coefficients'])
+
+## Saving and loading scenes
+def scene_to_dict(scene):
+    ''' Description of an OpticalScene or SimulatorScene in the form read by scene_from_dict'''
+    data = {
+        'size': list(scene.size),
+        'lasers': [],
+        'sources': [],
+        'mirrors': [],
+        'blocks': [],
+        'semicircles': [],
+        'lenses': [],
+        'curvedmirrors': [],
+        'detectors': []
+        }
+    for laser in scene.lasers:
+        entry = {'center': list(laser.center), 'rot': laser.rotdeg, 'decayincr': laser.decayincr, 'on': laser.on}
+        if laser.spectrum is not None:
+            entry['spectrum'] = list(laser.spectrum)
+        if laser.fresnel:
+            entry['fresnel'] = True
+        if not laser.batched:
+            data['lasers'].append(entry)
+            continue
+        entry.update({'type': laser.kind, 'count': laser.count})
+        if isinstance(laser, CollimatedBeam):
+            entry['width'] = laser.beamwidth
+        elif isinstance(laser, FanSource):
+            entry['spread'] = laser.spread
+        data['sources'].append(entry)
+    for mirror in scene.mirrors:
+        if isinstance(mirror, CurvedMirror):
+            data['curvedmirrors'].append({'pos1': list(mirror.pos1), 'pos2': list(mirror.pos2), 'radius': mirror.radius})
+        else:
+            data['mirrors'].append({'pos1': list(mirror.pos1), 'pos2': list(mirror.pos2)})
+    for block in scene.blocks:
+        if isinstance(block, SemiCircleBlock):
+            data['semicircles'].append({'center': list(block.center), 'radius': block.radius, 'rotation': block.rot, 'n': block.n})
+        elif isinstance(block, Lens):
+            data['lenses'].append({'center': list(block.center), 'radius': block.radius, 'thickness': block.thickness,
+                                   'n': block.n, 'rotation': block.rot, 'aperture': block.aperture})
+        else:
+            data['blocks'].append({'points': [list(point) for point in block.points], 'n': block.n})
+        if block.dispersion is not None:
+            kind = 'semicircles' if isinstance(block, SemiCircleBlock) else 'lenses' if isinstance(block, Lens) else 'blocks'
+            data[kind][-1]['dispersion'] = {'model': block.dispersion.model, 'coefficients': list(block.dispersion.coefficients)}
+    for detector in scene.detectors:
+        data['detectors'].append({'pos1': list(detector.pos1), 'pos2': list(detector.pos2), 'bins': detector.bins})
+    return data
+
+def save_scene(scene, filename):
+    ''' Save scene to a readable JSON file'''
+    with open(filename, 'w') as file:
+        json.dump(scene_to_dict(scene), file, indent=1)
+
+def load_scene(filename):
+    ''' Load a scene saved by save_scene'''
+    with open(filename) as file:
+        return scene_from_dict(json.load(file))
+
+# Compact binary format for many scenes. After the magic bytes is the length of each table as an
+# unsigned 64 bit integer, followed by the tables themselves in the same order
+ARCHIVE_MAGIC = b"OPTSCN06"
+ARCHIVE_TABLES = (
+    ('scenes', np.dtype([('width', '<f8'), ('height', '<f8'), ('laserstart', '<i8'), ('lasercount', '<i8'),
+                         ('mirrorstart', '<i8'), ('mirrorcount', '<i8'), ('blockstart', '<i8'), ('blockcount', '<i8'),
+                         ('detectorstart', '<i8'), ('detectorcount', '<i8')])),
+    # Spectra are ranges of the wavelengths table, a spectrumcount of -1 for lasers without one.
+    # kind is the position in ARCHIVE_SOURCES, with size the width of a collimated beam or spread of a fan
+    ('lasers', np.dtype([('x', '<f8'), ('y', '<f8'), ('rot', '<f8'), ('decayincr', '<f8'), ('on', '<i8'),
+                         ('spectrumstart', '<i8'), ('spectrumcount', '<i8'), ('fresnel', '<i8'),
+                         ('kind', '<i8'), ('size', '<f8'), ('count', '<i8')])),
+    # Flat mirrors have a radius of 0
+    ('mirrors', np.dtype([('x1', '<f8'), ('y1', '<f8'), ('x2', '<f8'), ('y2', '<f8'), ('radius', '<f8')])),
+    # Semicircles (kind 1) and lenses (kind 2) are stored by centre, radius, rotation and for lenses thickness and aperture.
+    # Other blocks (kind 0) by their points. dispersion is the model's position in ARCHIVE_DISPERSION, with 0 for none
+    ('blocks', np.dtype([('kind', '<i8'), ('n', '<f8'), ('x', '<f8'), ('y', '<f8'), ('radius', '<f8'), ('rotation', '<f8'),
+                         ('thickness', '<f8'), ('aperture', '<f8'), ('pointstart', '<i8'), ('pointcount', '<i8'),
+                         ('dispersion', '<i8'), ('coefficients', '<f8', (6,))])),
+    ('points', np.dtype([('x', '<f8'), ('y', '<f8')])),
+    ('wavelengths', np.dtype([('wavelength', '<f8')])),
+    ('detectors', np.dtype([('x1', '<f8'), ('y1', '<f8'), ('x2', '<f8'), ('y2', '<f8'), ('bins', '<i8')]))
+    )
+ARCHIVE_DISPERSION = (None, Cauchy, Sellmeier)
+ARCHIVE_SOURCES = (Laser, CollimatedBeam, FanSource, PointSource)
+
+def save_archive(scenes, filename):
+    ''' Save a list of scenes to the compact binary format read by SceneArchive'''
+    rows = {name: [] for name, dtype in ARCHIVE_TABLES}
+    for scene in scenes:
+        width, height = scene.size
+        rows['scenes'].append((width, height, len(rows['lasers']), len(scene.lasers), len(rows['mirrors']), len(scene.mirrors),
+                               len(rows['blocks']), len(scene.blocks), len(rows['detectors']), len(scene.detectors)))
+        for detector in scene.detectors:
+            rows['detectors'].append((detector.x1, detector.y1, detector.x2, detector.y2, detector.bins))
+        for laser in scene.lasers:
+            size = laser.beamwidth if isinstance(laser, CollimatedBeam) else getattr(laser, 'spread', 0)
+            source = (ARCHIVE_SOURCES.index(type(laser)), size, getattr(laser, 'count', 1))
+            if laser.spectrum is None:
+                rows['lasers'].append((laser.center[0], laser.center[1], laser.rotdeg, laser.decayincr, laser.on, 0, -1,
+                                       laser.fresnel) + source)
+            else:
+                rows['lasers'].append((laser.center[0], laser.center[1], laser.rotdeg, laser.decayincr, laser.on,
+                                       len(rows['wavelengths']), len(laser.spectrum), laser.fresnel) + source)
+                rows['wavelengths'].extend((wavelength,) for wavelength in laser.spectrum)
+        for mirror in scene.mirrors:
+            rows['mirrors'].append((mirror.x1, mirror.y1, mirror.x2, mirror.y2, getattr(mirror, 'radius', 0)))
+        for block in scene.blocks:
+            if block.dispersion is None:
+                dispersion = (0, [0] * 6)
+            else:
+                coefficients = list(block.dispersion.coefficients)
+                dispersion = (ARCHIVE_DISPERSION.index(type(block.dispersion)), coefficients + [0] * (6 - len(coefficients)))
+            if isinstance(block, SemiCircleBlock):
+                rows['blocks'].append((1, block.n, block.x, block.y, block.radius, block.rot, 0, 0, 0, 0) + dispersion)
+            elif isinstance(block, Lens):
+                rows['blocks'].append((2, block.n, block.x, block.y, block.radius, block.rot, block.thickness, block.aperture, 0, 0)
+                                      + dispersion)
+            else:
+                rows['blocks'].append((0, block.n, 0, 0, 0, 0, 0, 0, len(rows['points']), len(block.points)) + dispersion)
+                rows['points'].extend(block.points)
+
+    with open(filename, 'wb') as file:
+        file.write(ARCHIVE_MAGIC)
+        file.write(np.array([len(rows[name]) for name, dtype in ARCHIVE_TABLES], dtype='<u8').tobytes())
+        for name, dtype in ARCHIVE_TABLES:
+            file.write(np.array(rows[name], dtype=dtype).tobytes())
+
+class SceneArchive:
+
+    ''' Scenes saved by save_archive. The file is memory mapped so any one scene can be read
+    without reading or parsing the rest of the file'''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            magic = file.read(len(ARCHIVE_MAGIC))
+            if magic != ARCHIVE_MAGIC:
+                if magic[:6] == ARCHIVE_MAGIC[:6]:
+                    raise ValueError("{} is an unsupported version of scene archive".format(filename))
+                raise ValueError("{} is not a scene archive".format(filename))
+            counts = np.frombuffer(file.read(8 * len(ARCHIVE_TABLES)), dtype='<u8')
+
+        offset = len(ARCHIVE_MAGIC) + 8 * len(ARCHIVE_TABLES)
+        for (name, dtype), count in zip(ARCHIVE_TABLES, counts):
+            if count:
+                table = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(int(count),))
+            else:
+                # Can't memory map nothing
+                table = np.zeros(0, dtype=dtype)
+            setattr(self, name, table)
+            offset += int(count) * dtype.itemsize
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __getitem__(self, index):
+        ''' Build scene number index as an OpticalScene'''
+        row = self.scenes[index]
+        scene = OpticalScene((float(row['width']), float(row['height'])))
+        start = row['laserstart']
+        for x, y, rot, decayincr, on, spectrumstart, spectrumcount, fresnel, kind, size, count in \
+                self.lasers[start:start+row['lasercount']].tolist():
+            spectrum = None
+            if spectrumcount >= 0:
+                spectrum = self.wavelengths['wavelength'][spectrumstart:spectrumstart+spectrumcount].tolist()
+            source = ARCHIVE_SOURCES[kind]
+            shape = {CollimatedBeam: {'width': size, 'count': count}, FanSource: {'spread': size, 'count': count},
+                     PointSource: {'count': count}}.get(source, {})
+            scene.add(source((x,y), rot=rot, decayincr=decayincr, on=bool(on), spectrum=spectrum, fresnel=bool(fresnel),
+                             **shape))
+        start = row['mirrorstart']
+        for x1, y1, x2, y2, radius in self.mirrors[start:start+row['mirrorcount']].tolist():
+            if radius:
+                scene.add(CurvedMirror((x1,y1), (x2,y2), radius))
+            else:
+                scene.add(Mirror((x1,y1), (x2,y2)))
+        start = row['blockstart']
+        for kind, n, x, y, radius, rotation, thickness, aperture, pointstart, pointcount, model, coefficients in \
+                self.blocks[start:start+row['blockcount']].tolist():
+            dispersion = None
+            if model:
+                # Models with fewer coefficients have the rest padded with zeros
+                model = ARCHIVE_DISPERSION[model]
+                dispersion = model(*coefficients[:model.coefficientcount])
+            if kind == 1:
+                scene.add(SemiCircleBlock((x,y), radius, rotation, n, dispersion))
+            elif kind == 2:
+                scene.add(Lens((x,y), radius, thickness, n, rotation, aperture, dispersion))
+            else:
+                scene.add(Block(self.points[pointstart:pointstart+pointcount].tolist(), n, dispersion))
+        start = row['detectorstart']
+        for x1, y1, x2, y2, bins in self.detectors[start:start+row['detectorcount']].tolist():
+            scene.add(Detector((x1,y1), (x2,y2), bins))
+        return scene
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+def load_scenes(filename):
+    ''' Scenes in filename, either a SceneArchive or a JSON file holding one scene or a list of them'''
+    with open(filename, 'rb') as file:
+        # Any version of archive, so older ones get a clear error
+        binary = file.read(len(ARCHIVE_MAGIC))[:6] == ARCHIVE_MAGIC[:6]
+    if binary:
+        return SceneArchive(filename)
+    with open(filename) as file:
+        data = json.load(file)
+    if isinstance(data, dict):
+        data = [data]
+    return [scene_from_dict(scenedata) for scenedata in data]
+
+## Parameter sweeps
+def parse_values(spec):
+    ''' Values for a swept parameter from "start:stop:step" (stop included) or a comma separated list'''
+    if ':' in spec:
+        start, stop, step = (float(part) for part in spec.split(':'))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [start + i * step for i in range(count)]
+    return [float(value) for value in spec.split(',')]
+
+def set_parameter(data, name, value):
+    ''' Set parameter name of scene description data, such as "lasers.0.rot", "blocks.*.n" or "mirrors.1.pos2.0".
+    A * sets the parameter for every item of a list'''
+    parts = name.split('.')
+    targets = [data]
+    for part in parts[:-1]:
+        nexttargets = []
+        for target in targets:
+            if part == '*':
+                nexttargets.extend(target)
+            elif isinstance(target, list):
+                nexttargets.append(target[int(part)])
+            else:
+                nexttargets.append(target[part])
+        targets = nexttargets
+    last = parts[-1]
+    for target in targets:
+        if last == '*':
+            target[:] = [value] * len(target)
+        elif isinstance(target, list):
+            target[int(last)] = value
+        else:
+            target[last] = value
+
+def scene_variant(base, params):
+    ''' OpticalScene from scene description base with each parameter name in params set to its value.
+    base itself isn't changed'''
+    data = json.loads(json.dumps(base))
+    for name, value in params.items():
+        set_parameter(data, name, value)
+    return scene_from_dict(data)
+
+def check_variant(base, params):
+    ''' Raise an error if params don't fit scene description base, so a mistake in a parameter name is found
+    before starting any worker processes'''
+    scene_variant(base, params)
+
+def sweep_variants(grid):
+    ''' Every combination of the values in grid, a dictionary of parameter name to list of values'''
+    names = list(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+def variant_key(params):
+    ''' Identifies a variant in a results file so a sweep can be resumed'''
+    return json.dumps(params, sort_keys=True)
+
+def completed_variants(filename):
+    ''' Keys of variants already in results file filename. A partly written last line from an
+    interrupted sweep is removed so new results can be appended after it'''
+    done = set()
+    if not os.path.exists(filename):
+        return done
+    good = 0
+    with open(filename, 'rb') as file:
+        for line in file:
+            try:
+                done.add(variant_key(json.loads(line)['params']))
+            except (ValueError, KeyError):
+                break
+            if not line.endswith(b"\n"):
+                break
+            good += len(line)
+    with open(filename, 'r+b') as file:
+        file.truncate(good)
+    return done
+
+# Base scene and engine of each sweep worker process, set once by _sweep_init rather than sent with every variant
+_sweepbase = None
+_sweepengine = None
+
+def _sweep_init(base, engine):
+    global _sweepbase, _sweepengine
+    _sweepbase = base
+    _sweepengine = engine
+
+def _sweep_variant(params):
+    ''' Trace one variant of the base scene in a worker process'''
+    paths = trace(scene_variant(_sweepbase, params), _sweepengine)
+    return {'params': params, 'paths': [path.to_dict() for path in paths]}
+
+def run_sweep(base, grid, output, engine="particle", processes=None, chunksize=4):
+    ''' Trace every variant of scene description base over the parameter grid on a pool of processes.
+    Results are appended to output as JSON lines as they complete, and variants already in output are skipped.
+    Returns the number of variants traced'''
+    done = completed_variants(output)
+    variants = [params for params in sweep_variants(grid) if variant_key(params) not in done]
+    if not variants:
+        return 0
+    check_variant(base, variants[0])
+    with open(output, 'a') as file, multiprocessing.Pool(processes, _sweep_init, (base, engine)) as pool:
+        for result in pool.imap_unordered(_sweep_variant, variants, chunksize):
+            file.write(json.dumps(result) + "\n")
+            file.flush()
+    return len(variants)
+
+## Exporting pictures and animations
+def render_scene(scene, scale=1, engine="ray", supersample=1):
+    ''' Draw an OpticalScene as the simulator shows it without the banner and buttons, with every length multiplied by
+    scale. It is drawn supersample times larger again and smoothly shrunk down to soften the edges. Returns a Surface'''
+    paths = trace(scene, engine)
+    factor = scale * supersample
+    width, height = scene.size
+    surface = pygame.Surface((round(width * factor), round(height * factor)))
+    surface.fill(WHITE)
+    for block in scene.blocks:
+        block.draw(surface, factor)
+    for mirror in scene.mirrors:
+        mirror.draw(surface, factor)
+    for laser, path in zip(scene.lasers, paths):
+        laser.draw(surface, factor)
+        if laser.on:
+            draw_path(surface, path, factor)
+    for detector in scene.detectors:
+        detector.draw(surface, factor)
+    if supersample > 1:
+        surface = pygame.transform.smoothscale(surface, (round(width * scale), round(height * scale)))
+    return surface
+
+def animation_values(spec, frames):
+    ''' Value of an animated parameter in each of frames, changing steadily from "start:stop" or through evenly spaced
+    keyframes "a,b,c"'''
+    keys = [float(value) for value in spec.replace(':', ',').split(',')]
+    if frames == 1 or len(keys) == 1:
+        return [keys[0]] * frames
+    values = []
+    for frame in range(frames):
+        position = frame / (frames - 1) * (len(keys) - 1)
+        i = min(int(position), len(keys) - 2)
+        values.append(keys[i] + (keys[i+1] - keys[i]) * (position - i))
+    return values
+
+# Base scene and drawing options of each animation worker process, set once by _animation_init
+_animationbase = None
+_animationoptions = None
+
+def _animation_init(base, options):
+    global _animationbase, _animationoptions
+    _animationbase = base
+    _animationoptions = options
+
+def _animation_frame(params):
+    ''' Render one frame in a worker process, returned as PNG data so it is quick to send back'''
+    file = io.BytesIO()
+    pygame.image.save(render_scene(scene_variant(_animationbase, params), **_animationoptions), file, "png")
+    return file.getvalue()
+
+def run_animation(base, tracks, frames, output, scale=1, engine="ray", supersample=1, processes=None):
+    ''' Render frames of scene description base as PNG images on a pool of processes, animating the parameters in
+    tracks, a dictionary of parameter name to animation_values spec. output is a file name to format with the frame
+    number, such as "frames/{:04d}.png", or a binary file the images are written to one after another. Frames are
+    written in order, and only a few are rendered ahead of the one being written so they don't build up in memory.
+    Returns the number of frames'''
+    values = {name: animation_values(spec, frames) for name, spec in tracks.items()}
+    variants = [{name: values[name][frame] for name in values} for frame in range(frames)]
+    check_variant(base, variants[0])
+
+    def write(frame, image):
+        if isinstance(output, str):
+            filename = output.format(frame)
+            if os.path.dirname(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as file:
+                file.write(image)
+        else:
+            output.write(image)
+            output.flush()
+
+    options = {'scale': scale, 'engine': engine, 'supersample': supersample}
+    ahead = 2 * (processes or os.cpu_count() or 1)
+    with multiprocessing.Pool(processes, _animation_init, (base, options)) as pool:
+        pending = deque()
+        for frame, params in enumerate(variants):
+            pending.append((frame, pool.apply_async(_animation_frame, (params,))))
+            if len(pending) >= ahead:
+                done, result = pending.popleft()
+                write(done, result.get())
+        while pending:
+            done, result = pending.popleft()
+            write(done, result.get())
+    return frames
+
+class Profiler:
+
+    ''' Records how long each phase of every frame takes and what it cost to trace the lasers that were
+    retraced. Shows the frame time on screen, with the full breakdown when showoverlay is set, and can
+    save the records as CSV or JSON'''
+
+    # Phases of the main loop in the order they run
+    PHASES = ('input', 'update', 'render')
+
+    def __init__(self, maxframes=100000, smoothing=0.9):
+        # Records of recent frames, oldest are dropped after maxframes
+        self.frames = deque(maxlen=maxframes)
+        self.framecount = 0
+        self.current = None
+        self.showoverlay = False
+
+        # Averages shown on screen are smoothed over recent frames so they are readable
+        self.smoothing = smoothing
+        self.averages = {}
+        # One for each line of the overlay, so lines that haven't changed aren't rendered again
+        self.labels = []
+
+    def start_frame(self):
+        self.framecount += 1
+        self.current = {'frame': self.framecount}
+        self.starttime = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        ''' Time the code run inside the with block as phase name of the current frame'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] = time.perf_counter() - start
+
+    def end_frame(self, traced, policy="live"):
+        ''' Finish the current frame. traced is a list of the BeamPaths traced during it and policy is how the main loop
+        ran it, "idle" if it waited for input first'''
+        frame = self.current
+        frame['policy'] = policy
+        frame['total'] = time.perf_counter() - self.starttime
+        frame['lasers'] = [{'steps': path.steps, 'tests': path.tests, 'bounces': path.bounces, 'rays': path.rays,
+                            'pruned': path.pruned, 'trace': path.tracetime} for path in traced]
+        for name in ('steps', 'tests', 'bounces', 'rays', 'pruned', 'trace'):
+            frame[name] = sum(laser[name] for laser in frame['lasers'])
+        self.frames.append(frame)
+
+        for name in self.PHASES + ('total', 'trace', 'steps', 'tests', 'bounces', 'rays', 'pruned'):
+            value = frame.get(name, 0)
+            self.averages[name] = self.smoothing * self.averages.get(name, value) + (1 - self.smoothing) * value
+
+    def draw(self, screen, assets):
+        ''' Draw the frame time, and the breakdown if showoverlay is set. Returns the areas of the screen drawn over'''
+        lines = ["Frame: {:.1f} ms".format(self.averages.get('total', 0) * 1000)]
+        if self.showoverlay:
+            lines.append("  ".join("{} {:.1f}".format(name, self.averages.get(name, 0) * 1000) for name in self.PHASES))
+            lines.append("trace {:.1f} ms".format(self.averages.get('trace', 0) * 1000))
+            lines.append("steps {:.0f}  tests {:.0f}  bounces {:.0f}".format(
+                self.averages.get('steps', 0), self.averages.get('tests', 0), self.averages.get('bounces', 0)))
+            lines.append("rays {:.0f}  pruned {:.0f}".format(self.averages.get('rays', 0), self.averages.get('pruned', 0)))
+            lines.append("policy " + self.frames[-1]['policy'])
+            lines.append("F4 to save profile.csv")
+        while len(self.labels) < len(lines):
+            self.labels.append(Label("", "smallFont", MEDIUMGREY))
+        y = 50
+        rects = []
+        for label, line in zip(self.labels, lines):
+            label.text = line
+            textRect = label.draw(screen, "topright", (screen.get_width()-5, y), assets)
+            rects.append(textRect)
+            y = textRect.bottom
+        return rects
+
+    def dump(self, filename):
+        ''' Save frame records to filename. JSON if it ends in .json, including each laser traced, otherwise CSV of
+        per frame totals. Times are in milliseconds'''
+        columns = ('frame',) + self.PHASES + ('total', 'trace', 'lasers', 'steps', 'tests', 'bounces', 'rays', 'pruned', 'policy')
+        rows = []
+        for frame in self.frames:
+            row = dict(frame)
+            for name in self.PHASES + ('total', 'trace'):
+                row[name] = row.get(name, 0) * 1000
+            row['lasers'] = [dict(laser, trace=laser['trace'] * 1000) for laser in frame['lasers']]
+            rows.append(row)
+
+        with open(filename, 'w', newline='') as file:
+            if filename.endswith('.json'):
+                json.dump({'frames': rows}, file)
+            else:
+                writer = csv.writer(file)
+                writer.writerow(columns)
+                for row in rows:
+                    writer.writerow([len(row['lasers']) if name == 'lasers' else row.get(name, 0) for name in columns])
+
+def main(width, height, fps, profiler=None, ondemand=True):
+    ''' Run the simulator in a window. With ondemand, scenes whose Policy is "idle" wait for input instead of being
+    redrawn every frame, so the simulator uses almost no CPU when nothing is changing'''
     # Initialisation
     pygame.init()
     pygame.display.set_caption('Optics Simulation')
@@ -615,39 +3704,188 @@ def main(width, height, fps):
 
     # Fonts used across the scenes
     assets = {
-        'smallFont' : pygame.font.SysFont('arial', 20),
-        'mediumFont' : pygame.font.SysFont('arial', 25),
-        'largeFont' : pygame.font.SysFont('arial', 35)
+        'smallFont' : load_font('arial', 20),
+        'mediumFont' : load_font('arial', 25),
+        'largeFont' : load_font('arial', 35)
         }
 
-    # Set scene to the simulator
-    active_scene = SimulatorScene()
+    # Set scene to the simulator, tracing in the background so the window keeps responding
+    worker = TraceWorker(notify=lambda: pygame.event.post(pygame.event.Event(TRACED)))
+    active_scene = SimulatorScene(worker)
+    if profiler is None:
+        profiler = Profiler()
 
     # Main Loop
     while active_scene != None:
 
-        # Event handling
-        events = pygame.event.get()
+        # Event handling, waiting for the next event first if the scene has nothing to do until then
+        policy = active_scene.Policy() if ondemand else "live"
+        if policy == "idle":
+            events = [pygame.event.wait()] + pygame.event.get()
+        else:
+            events = pygame.event.get()
         for event in events:
             # Allow the window to be any size
             if event.type == VIDEORESIZE:
                 screen=pygame.display.set_mode(event.dict['size'],HWSURFACE|DOUBLEBUF|RESIZABLE)
+                active_scene.Invalidate()
+            # Window contents lost, such as after being uncovered
+            elif event.type == VIDEOEXPOSE:
+                active_scene.Invalidate()
             # Close the program
             elif event.type == pygame.QUIT:
                 active_scene.Terminate()
-
-        active_scene.ProcessInput(events)
-        active_scene.Update()
-        active_scene.Render(screen,assets)
+            # Profiling overlay and saving
+            elif event.type == KEYDOWN and event.key == K_F3:
+                profiler.showoverlay = not profiler.showoverlay
+            elif event.type == KEYDOWN and event.key == K_F4:
+                profiler.dump("profile.csv")
+
+        profiler.start_frame()
+        with profiler.phase('input'):
+            active_scene.ProcessInput(events)
+        with profiler.phase('update'):
+            active_scene.Update()
+        with profiler.phase('render'):
+            active_scene.Render(screen,assets)
+        profiler.end_frame(active_scene.traced, policy)
+        overlay = profiler.draw(screen, assets)
+
+        # Only the areas of the screen that changed are sent to the display. The overlay is drawn over the scene
+        # each frame, so the scene draws those areas again underneath it next time
+        if active_scene.dirty is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(active_scene.dirty + overlay)
+        active_scene.Invalidate(overlay)
 
         active_scene = active_scene.next
-
-        pygame.display.update()
         clock.tick(fps)
 
-    # Quit program
+    # Quit program, fonts can't be used once pygame has quit
+    worker.stop()
+    load_font.cache_clear()
+    TEXT_CACHE.clear()
     pygame.quit()
+    return profiler
+
+def trace_command(args):
+    ''' Trace scene files and write one JSON line of paths for each scene'''
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for filename in args.scenes:
+            for index, scene in enumerate(load_scenes(filename)):
+                paths = trace(scene, args.engine)
+                result = {'file': filename, 'index': index, 'paths': [path.to_dict() for path in paths]}
+                if scene.detectors:
+                    result['detectors'] = [detector.to_dict() for detector in scene.detectors]
+                output.write(json.dumps(result) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+def sweep_command(args):
+    ''' Run a parameter sweep over a base scene file'''
+    with open(args.scene) as file:
+        base = json.load(file)
+    grid = {}
+    for setting in args.set:
+        name, spec = setting.split('=', 1)
+        grid[name] = parse_values(spec)
+    count = run_sweep(base, grid, args.output, args.engine, args.processes)
+    print("Traced {} variants to {}".format(count, args.output), file=sys.stderr)
+
+def render_command(args):
+    ''' Save a picture of a scene from a file'''
+    scene = load_scenes(args.scene)[args.index]
+    pygame.image.save(render_scene(scene, args.scale, args.engine, args.supersample), args.output)
+
+def animate_command(args):
+    ''' Render an animation of a base scene file with parameters changing over the frames'''
+    with open(args.scene) as file:
+        base = json.load(file)
+    tracks = {}
+    for setting in args.set:
+        name, spec = setting.split('=', 1)
+        tracks[name] = spec
+    output = sys.stdout.buffer if args.output == "-" else args.output
+    count = run_animation(base, tracks, args.frames, output, args.scale, args.engine, args.supersample, args.processes)
+    print("Rendered {} frames".format(count), file=sys.stderr)
+
+def convert_command(args):
+    ''' Convert between JSON scene files and scene archives'''
+    scenes = []
+    for filename in args.scenes:
+        scenes.extend(load_scenes(filename))
+    if args.output.endswith(".json"):
+        with open(args.output, 'w') as file:
+            json.dump([scene_to_dict(scene) for scene in scenes], file, indent=1)
+    else:
+        save_archive(scenes, args.output)
+
+def cli(argv=None):
+    ''' Command line interface. With no command the simulator window is opened'''
+    parser = argparse.ArgumentParser(prog="OpticsSim", description="Light simulator demonstrating reflection and refraction")
+    commands = parser.add_subparsers(dest="command")
+
+    traceparser = commands.add_parser("trace", help="trace JSON scene files without opening a window")
+    traceparser.add_argument("scenes", nargs="+", help="scene archives or JSON files each holding a scene or a list of scenes")
+    traceparser.add_argument("--engine", choices=ENGINES, default="ray")
+    traceparser.add_argument("-o", "--output", help="file to write results to instead of standard output")
+
+    sweepparser = commands.add_parser("sweep", help="trace every combination of parameter values over a base scene")
+    sweepparser.add_argument("scene", help="JSON file holding the base scene")
+    sweepparser.add_argument("--set", action="append", required=True, metavar="NAME=VALUES",
+                             help='parameter and values, e.g. "lasers.0.rot=0:90:0.5" or "blocks.*.n=1.33,1.52"')
+    sweepparser.add_argument("-o", "--output", required=True, help="JSON lines results file, resumed if it exists")
+    sweepparser.add_argument("--engine", choices=ENGINES, default="particle")
+    sweepparser.add_argument("-j", "--processes", type=int, help="number of worker processes, all cores by default")
+
+    renderparser = commands.add_parser("render", help="save a picture of a scene at any resolution without opening a window")
+    renderparser.add_argument("scene", help="scene archive or JSON scene file")
+    renderparser.add_argument("-o", "--output", required=True, help="image file to save, such as picture.png")
+    renderparser.add_argument("--index", type=int, default=0, help="which scene of a file holding several to draw")
+    renderparser.add_argument("--scale", type=float, default=1, help="size of the picture compared to the scene")
+    renderparser.add_argument("--supersample", type=int, default=1, help="draw this many times larger and shrink to smooth edges")
+    renderparser.add_argument("--engine", choices=ENGINES, default="ray")
+
+    animateparser = commands.add_parser("animate", help="render frames of a scene with parameters changing over them")
+    animateparser.add_argument("scene", help="JSON file holding the base scene")
+    animateparser.add_argument("--set", action="append", required=True, metavar="NAME=VALUES",
+                               help='parameter and values it moves between, e.g. "lasers.0.rot=0:90" or "blocks.0.n=1.33,1.52,1.33"')
+    animateparser.add_argument("--frames", type=int, required=True)
+    animateparser.add_argument("-o", "--output", required=True,
+                               help='frame file names with the frame number, e.g. "frames/{:04d}.png", or - to write them all to standard output')
+    animateparser.add_argument("--scale", type=float, default=1, help="size of the frames compared to the scene")
+    animateparser.add_argument("--supersample", type=int, default=1, help="draw this many times larger and shrink to smooth edges")
+    animateparser.add_argument("--engine", choices=ENGINES, default="ray")
+    animateparser.add_argument("-j", "--processes", type=int, help="number of worker processes, all cores by default")
+
+    convertparser = commands.add_parser("convert", help="combine scene files into a scene archive, or back to JSON")
+    convertparser.add_argument("scenes", nargs="+", help="scene archives or JSON scene files")
+    convertparser.add_argument("-o", "--output", required=True, help="output file, JSON if it ends in .json otherwise an archive")
+
+    parser.add_argument("--profile", metavar="FILE",
+                        help="when the simulator closes, save frame and trace timings to FILE (.csv or .json)")
+    parser.add_argument("--continuous", action="store_true",
+                        help="redraw the simulator every frame even when nothing is changing")
+
+    args = parser.parse_args(argv)
+    if args.command == "trace":
+        trace_command(args)
+    elif args.command == "convert":
+        convert_command(args)
+    elif args.command == "render":
+        render_command(args)
+    elif args.command == "animate":
+        animate_command(args)
+    elif args.command == "sweep":
+        sweep_command(args)
+    else:
+        profiler = main(700,600,30, ondemand=not args.continuous)
+        if args.profile:
+            profiler.dump(args.profile)
 
 # Allow classes to be used by other programs in future development so only execute if main
 if __name__ == "__main__":
-    main(700,600,30)
+    cli()
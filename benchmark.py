@@ -0,0 +1,347 @@
+# -*- coding: UTF-8 -*-
+''' Benchmarks for the optics tracer. Runs without a window using the dummy SDL video driver.
+
+Usage: python benchmark.py suite -o results.json [--compare old.json]
+       python benchmark.py index
+       python benchmark.py sources
+       python benchmark.py check'''
+#Imports
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+
+import OpticsSim
+from OpticsSim import (BK7, Block, CollimatedBeam, CurvedMirror, Detector, FanSource, Laser, Lens, Mirror, OpticalScene,
+                       PointSource, SceneGeometry, SemiCircleBlock, SimulatorScene)
+import pygame
+
+## Canonical scenes
+def prism_array(count, size=(700,600), seed=0):
+    ''' Scene of count small triangular prisms scattered over the screen'''
+    rand = random.Random(seed)
+    width, height = size
+    blocks = []
+    for i in range(count):
+        x = rand.uniform(20, width - 40)
+        y = rand.uniform(20, height - 40)
+        side = rand.uniform(8, 20)
+        blocks.append(Block([(x,y), (x+side,y), (x+side/2,y-side*math.sqrt(3)/2)], 1.52))
+    return blocks
+
+def laser_fan(count, size=(700,600)):
+    ''' count lasers along the left edge of the screen, pointing right at a spread of angles'''
+    width, height = size
+    return [Laser((40, height*(i+1)/(count+1)), rot=-90+20*math.sin(i), decayincr=0.01) for i in range(count)]
+
+def single_mirror():
+    ''' One laser reflecting off one mirror'''
+    scene = OpticalScene()
+    scene.add(Laser((100,300), rot=-90, decayincr=0.01))
+    scene.add(Mirror((450,150), (500,450)))
+    return scene
+
+def mirror_corridor():
+    ''' Laser entering a narrow corridor between two long parallel mirrors, reflecting many times'''
+    scene = OpticalScene()
+    scene.add(Laser((20,312), rot=-70, decayincr=0.01))
+    scene.add(Mirror((60,295), (680,295)))
+    scene.add(Mirror((60,305), (680,305)))
+    return scene
+
+def prisms():
+    ''' Lasers through an array of 300 small prisms'''
+    scene = OpticalScene()
+    for obj in laser_fan(10) + prism_array(300):
+        scene.add(obj)
+    return scene
+
+def semicircle_tir():
+    ''' Laser entering the flat face of a semicircular block away from the centre so it is totally
+    internally reflected round the curved face'''
+    scene = OpticalScene()
+    scene.add(Laser((240,80), rot=180, decayincr=0.01))
+    scene.add(SemiCircleBlock((350,300), 150, math.pi/2, 1.52))
+    return scene
+
+def many_lasers():
+    ''' Hundreds of lasers across a few mirrors and blocks'''
+    scene = OpticalScene()
+    for i in range(200):
+        scene.add(Laser((30 + 640*(i % 20)/19, 60 + 40*(i // 20)), rot=(37*i) % 360, decayincr=0.01))
+    scene.add(Mirror((100,520), (600,560)))
+    scene.add(Mirror((650,100), (680,500)))
+    scene.add(Block([(200,200), (350,180), (320,320)], 1.52))
+    scene.add(SemiCircleBlock((480,330), 90, 2.0, 1.52))
+    return scene
+
+def optical_bench():
+    ''' Parallel lasers focused by a row of lenses and turned back by a concave mirror'''
+    scene = OpticalScene()
+    for i in range(9):
+        scene.add(Laser((30, 260 + 10*i), rot=-90, decayincr=0.01))
+    scene.add(Lens((150,300), 200, 20, 1.52, math.pi/2))
+    scene.add(Lens((300,300), -150, 8, 1.52, math.pi/2, aperture=120))
+    scene.add(Lens((420,300), 120, 30, 1.52, math.pi/2))
+    scene.add(CurvedMirror((640,220), (640,380), 250))
+    return scene
+
+def white_prism():
+    ''' White lasers split into their spectrum by a glass prism'''
+    scene = OpticalScene()
+    for i in range(5):
+        scene.add(Laser((60, 340 + 10*i), rot=-75, decayincr=0.01, spectrum=OpticsSim.VISIBLE_SPECTRUM))
+    scene.add(Block([(300,200), (420,420), (180,420)], 1.5168, BK7))
+    return scene
+
+def glass_reflections():
+    ''' Lasers partially reflecting back and forth through a stack of glass plates and a lens'''
+    scene = OpticalScene()
+    for i in range(5):
+        scene.add(Laser((40, 250 + 25*i), rot=-80, decayincr=0.01, fresnel=True))
+    for i in range(4):
+        scene.add(Block([(200 + 60*i,150), (230 + 60*i,150), (230 + 60*i,450), (200 + 60*i,450)], 1.52))
+    scene.add(Lens((550,300), 150, 30, 1.52, math.pi/2))
+    return scene
+
+def light_sources():
+    ''' Collimated beam, fan and point source shining through lenses onto a detector'''
+    scene = OpticalScene()
+    scene.add(CollimatedBeam((40,150), rot=-90, width=60, count=50, decayincr=0.01))
+    scene.add(FanSource((40,420), rot=-90, spread=30, count=50, decayincr=0.01))
+    scene.add(PointSource((350,560), count=72, decayincr=0.01))
+    scene.add(Lens((250,150), 150, 30, 1.52, math.pi/2))
+    scene.add(Lens((250,420), 120, 30, 1.52, math.pi/2))
+    scene.add(Detector((600,50), (600,550)))
+    return scene
+
+SCENES = {
+    'single_mirror': single_mirror,
+    'mirror_corridor': mirror_corridor,
+    'prisms': prisms,
+    'semicircle_tir': semicircle_tir,
+    'many_lasers': many_lasers,
+    'optical_bench': optical_bench,
+    'white_prism': white_prism,
+    'glass_reflections': glass_reflections,
+    'light_sources': light_sources
+    }
+
+## Measurements
+def trace_all(scene, engine):
+    ''' Trace every laser without using cached paths'''
+    return [laser.trace(engine, scene.size, scene.mirrors, scene.blocks, scene.geometry) for laser in scene.lasers]
+
+def time_trace(lasers, blocks, geometry, size, repeats):
+    ''' Best time over repeats to trace every laser with the ray engine'''
+    best = math.inf
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        for laser in lasers:
+            laser.trace_ray(size, [], blocks, geometry)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def time_frames(scene, engine, screen, assets):
+    ''' Render time of the simulator showing scene, for the first frame where every laser is traced
+    and the next where nothing has changed so nothing is drawn again'''
+    simulator = SimulatorScene()
+    simulator.LoadScene(scene)
+    simulator.engine = engine
+    times = []
+    for frame in range(2):
+        start = time.perf_counter()
+        simulator.Render(screen, assets)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_scene(name, engine, repeats, screen, assets):
+    ''' Measurements of one canonical scene traced by engine'''
+    scene = SCENES[name]()
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        paths = trace_all(scene, engine)
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured on a separate run as tracemalloc slows everything down
+    tracemalloc.start()
+    trace_all(scene, engine)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    coldframe, frame = time_frames(scene, engine, screen, assets)
+    return {
+        'scene': name,
+        'engine': engine,
+        'lasers': len(scene.lasers),
+        'lines': scene.geometry.count,
+        'trace_ms': min(times) * 1000,
+        'trace_ms_mean': sum(times) / len(times) * 1000,
+        'frame_cold_ms': coldframe * 1000,
+        'frame_ms': frame * 1000,
+        'peak_kib': peak / 1024,
+        'steps': sum(path.steps for path in paths),
+        'tests': sum(path.tests for path in paths),
+        'bounces': sum(path.bounces for path in paths),
+        'rays': sum(path.rays for path in paths),
+        'pruned': sum(path.pruned for path in paths)
+        }
+
+def metadata():
+    ''' Details of the run so results from different machines and commits can be told apart'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pygame.version.ver,
+        'platform': platform.platform(),
+        'processor': platform.processor()
+        }
+
+def bench_suite(scenes, engines, repeats, output=None, compare=None):
+    ''' Benchmark each scene with each engine, print a table and optionally save results as JSON'''
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((700,600))
+    # Default font so the benchmark doesn't depend on installed system fonts
+    assets = {
+        'smallFont' : pygame.font.Font(None, 24),
+        'mediumFont' : pygame.font.Font(None, 30),
+        'largeFont' : pygame.font.Font(None, 42)
+        }
+
+    previous = {}
+    if compare:
+        with open(compare) as file:
+            for result in json.load(file)['results']:
+                previous[result['scene'], result['engine']] = result
+
+    results = []
+    print("{:<16} {:<9} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        "scene", "engine", "trace/ms", "cold/ms", "frame/ms", "peak/KiB", "vs old"))
+    for name in scenes:
+        for engine in engines:
+            result = bench_scene(name, engine, repeats, screen, assets)
+            results.append(result)
+            old = previous.get((name, engine))
+            change = "{:.2f}x".format(old['trace_ms'] / result['trace_ms']) if old else ""
+            print("{:<16} {:<9} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f} {:>9}".format(
+                name, engine, result['trace_ms'], result['frame_cold_ms'], result['frame_ms'], result['peak_kib'], change))
+    pygame.quit()
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'meta': metadata(), 'results': results}, file, indent=1)
+    return results
+
+def bench_index(counts, lasercount, repeats, size=(700,600)):
+    ''' Trace time against number of lines with and without the LineGrid spatial index'''
+    lasers = laser_fan(lasercount, size)
+    print("{:>8} {:>12} {:>12} {:>8}".format("lines", "no index/ms", "index/ms", "speedup"))
+    for count in counts:
+        blocks = prism_array(count, size)
+        times = []
+        # Threshold above the line count disables the index, zero always uses it
+        for threshold in (math.inf, 0):
+            geometry = SceneGeometry(indexthreshold=threshold)
+            for block in blocks:
+                geometry.add(block)
+            times.append(time_trace(lasers, blocks, geometry, size, repeats))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>8.2f}".format(geometry.count, times[0]*1000, times[1]*1000, times[0]/times[1]))
+
+def bench_sources(counts, repeats, size=(700,600)):
+    ''' Rays per second traced from a collimated beam through a lens onto a detector, keeping every path as the
+    simulator does and only measuring with the detector'''
+    scene = OpticalScene(size)
+    scene.add(Lens((300,300), 150, 30, 1.52, math.pi/2))
+    scene.add(Mirror((500,100), (550,250)))
+    scene.add(Detector((650,50), (650,550)))
+    print("{:>9} {:>12} {:>12} {:>14} {:>14}".format("rays", "paths/ms", "detect/ms", "paths rays/s", "detect rays/s"))
+    for count in counts:
+        source = CollimatedBeam((40,300), rot=-90, width=200, count=count, decayincr=0.01)
+        times = [math.inf, math.inf]
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            source.trace("ray", size, scene.mirrors, scene.blocks, scene.geometry)
+            times[0] = min(times[0], time.perf_counter() - start)
+            start = time.perf_counter()
+            OpticsSim.detect(scene, *source.rays())
+            times[1] = min(times[1], time.perf_counter() - start)
+        print("{:>9} {:>12.2f} {:>12.2f} {:>14.0f} {:>14.0f}".format(count, times[0]*1000, times[1]*1000,
+                                                                    count / times[0], count / times[1]))
+
+def check_engines(scenes, engines, tolerance):
+    ''' Compare the end point and number of bounces of every laser traced by each engine with the exact ray engine.
+    Prints the lasers that differ and returns whether they all agree'''
+    agree = True
+    for name in scenes:
+        scene = SCENES[name]()
+        exact = trace_all(scene, "ray")
+        for engine in engines:
+            differ = []
+            for index, (expected, path) in enumerate(zip(exact, trace_all(scene, engine))):
+                for expected, path in zip(getattr(expected, 'paths', [expected]), getattr(path, 'paths', [path])):
+                    (x1, y1), (x2, y2) = expected.points[-1], path.points[-1]
+                    if expected.bounces != path.bounces or math.hypot(x2 - x1, y2 - y1) > tolerance:
+                        differ.append((index, expected.bounces, path.bounces, (x1, y1), (x2, y2)))
+                        break
+            print("{:<17} {:<9} {} of {} lasers differ".format(name, engine, len(differ), len(exact)))
+            for index, expectedbounces, bounces, expectedend, end in differ:
+                print("    laser {}: {} bounces ending at ({:.2f}, {:.2f}), ray engine {} ending at ({:.2f}, {:.2f})"
+                      .format(index, bounces, *end, expectedbounces, *expectedend))
+            agree = agree and not differ
+    return agree
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    suiteparser = commands.add_parser("suite", help="trace and frame times and memory of the canonical scenes")
+    suiteparser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    suiteparser.add_argument("--engines", nargs="+", choices=OpticsSim.ENGINES, default=list(OpticsSim.ENGINES))
+    suiteparser.add_argument("--repeats", type=int, default=3)
+    suiteparser.add_argument("-o", "--output", help="JSON file to save results to")
+    suiteparser.add_argument("--compare", metavar="OLD", help="results JSON from an earlier run to compare trace times with")
+
+    indexparser = commands.add_parser("index", help="trace time against number of lines with and without the spatial index")
+    indexparser.add_argument("--counts", type=int, nargs="+", default=[10, 30, 100, 300, 1000, 3000],
+                             help="numbers of prisms to benchmark")
+    indexparser.add_argument("--lasers", type=int, default=20)
+    indexparser.add_argument("--repeats", type=int, default=3)
+
+    sourcesparser = commands.add_parser("sources", help="rays per second traced from a light source")
+    sourcesparser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000],
+                               help="numbers of rays to benchmark")
+    sourcesparser.add_argument("--repeats", type=int, default=3)
+
+    checkparser = commands.add_parser("check", help="check other engines give the same paths as the ray engine")
+    checkparser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    checkparser.add_argument("--engines", nargs="+", choices=OpticsSim.ENGINES, default=["adaptive"])
+    checkparser.add_argument("--tolerance", type=float, default=0.5, help="furthest apart end points can be, in pixels")
+
+    args = parser.parse_args()
+    if args.command == "suite":
+        bench_suite(args.scenes, args.engines, args.repeats, args.output, args.compare)
+    elif args.command == "index":
+        bench_index(args.counts, args.lasers, args.repeats)
+    elif args.command == "sources":
+        bench_sources(args.counts, args.repeats)
+    else:
+        sys.exit(0 if check_engines(args.scenes, args.engines, args.tolerance) else 1)